@@ -0,0 +1,78 @@
+"""
+    Compares the batched group scorer in rewards.py with scoring each completion
+    separately through list membership, as the entity rewards used to, on long,
+    entity-dense synthetic documents.
+
+    Run from the repository root with `python -m benchmarks.bench_entity_scorer`.
+"""
+import time
+import random
+import argparse
+
+from typing import List
+from rewards import extract_entity_contents, extract_xml_answer, parse_completion, score_entity_groups
+
+
+def legacy_positive(answer_entity_list: List[str], out_entity_list: List[str]) -> float:
+    score = 0.0
+    for entity in answer_entity_list:
+        score += 0.5 if entity in out_entity_list else 0.0
+    return score
+
+
+def legacy_negative(answer_entity_list: List[str], out_entity_list: List[str]) -> float:
+    score = 0.0
+    for entity in out_entity_list:
+        if entity not in answer_entity_list:
+            score -= 0.5
+    return score
+
+
+def legacy_scores(answer: List[str], responses: List[str]):
+    extracted = [extract_xml_answer(r) for r in responses]
+    positive = [legacy_positive(extract_entity_contents(a), extract_entity_contents(r)) for a, r in zip(answer, extracted)]
+    negative = [legacy_negative(extract_entity_contents(a), extract_entity_contents(r)) for a, r in zip(answer, extracted)]
+    exact = [2.0 if r == str(a) else 0.0 for r, a in zip(extracted, answer)]
+    return positive, negative, exact
+
+
+def make_batch(num_prompts: int, group_size: int, num_entities: int, seed: int = 0):
+    rng = random.Random(seed)
+    answer, responses = [], []
+    for _ in range(num_prompts):
+        vocab = [f"Entity {rng.randrange(num_entities * 4)}" for _ in range(num_entities * 2)]
+        truth = rng.sample(vocab, num_entities) + rng.sample(vocab, num_entities // 10)  # a few duplicates
+        gt = "<entity>" + " , ".join(truth) + "</entity>"
+        for _ in range(group_size):
+            out = rng.sample(truth, len(truth) // 2) + rng.sample(vocab, num_entities // 2)
+            answer.append(gt)
+            responses.append("<think> ... </think> <entity>" + ", ".join(out) + "</entity>")
+    return answer, responses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=4)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--entities", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    for num_entities in args.entities:
+        answer, responses = make_batch(args.prompts, args.group_size, num_entities)
+
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            expected = legacy_scores(answer, responses)
+        legacy = (time.perf_counter() - start) / args.repeats
+
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            scores = score_entity_groups(answer, [parse_completion(r) for r in responses])
+        batched = (time.perf_counter() - start) / args.repeats
+
+        assert tuple(scores) == expected
+        print(
+            f"entities={num_entities:<5} completions={len(responses):<4} "
+            f"legacy={legacy * 1e3:9.2f}ms batched={batched * 1e3:9.2f}ms speedup={legacy / batched:6.1f}x"
+        )
@@ -0,0 +1,95 @@
+"""
+    Compares prompts built with the static ENTITY_EXAMPLES block against prompts whose
+    examples are retrieved per context by fewshot.FewShotSelector: prompt length,
+    render throughput with a cold and a warm selection cache, selection latency, and
+    how many of the retrieved examples show at least one entity of the prompt's type.
+
+    Tokens are counted by whitespace split unless --tokenizer names a HF tokenizer.
+
+    Run from the repository root with `python -m benchmarks.bench_fewshot`.
+"""
+import time
+import argparse
+import numpy as np
+
+from data_loading import CACHE_DIR, JOINT_ENTITY, load_conll_dataset
+from fewshot import FewShotSelector, tokenize, whitespace_tokens
+
+
+def prompt_lengths(dataset, count_tokens, limit: int) -> np.ndarray:
+    rows = dataset[:limit]
+    return np.array([count_tokens(prompt[0]["content"]) for prompt in rows["prompt"]])
+
+
+def render_rate(dataset, limit: int, batch_size: int = 256) -> float:
+    start = time.perf_counter()
+    for offset in range(0, limit, batch_size):
+        dataset[offset : min(offset + batch_size, limit)]
+    return limit / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train", default="data/conll03/mrc-ner.train", help="pool the examples are drawn from")
+    parser.add_argument("--data", default="data/conll03/mrc-ner.test", help="prompts to build")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--tokenizer", default=None)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--token-budget", type=int, default=384)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--joint", action="store_true")
+    args = parser.parse_args()
+
+    count_tokens = whitespace_tokens
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        count_tokens = lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    start = time.perf_counter()
+    selector = FewShotSelector.from_conll(
+        args.train, cache_dir=args.cache_dir, k=args.k, token_budget=args.token_budget, count_tokens=count_tokens
+    )
+    print(f"Indexed {len(selector.contexts)} pool sentences in {time.perf_counter() - start:.2f}s")
+
+    static = load_conll_dataset(args.data, compact=True, joint=args.joint, cache_dir=args.cache_dir)
+    dynamic = load_conll_dataset(
+        args.data, compact=True, joint=args.joint, cache_dir=args.cache_dir, example_selector=selector
+    )
+    rows = min(args.rows, len(static))
+
+    static_rate = render_rate(static, rows)
+    cold_rate = render_rate(dynamic, rows)
+    warm_rate = render_rate(dynamic, rows)
+
+    static_tokens = prompt_lengths(static, count_tokens, rows)
+    dynamic_tokens = prompt_lengths(dynamic, count_tokens, rows)
+
+    # the context is the last user turn of the prompt
+    head = static[:rows]
+    contexts = [prompt[0]["content"].rsplit("User:", 1)[-1].split("Assistant:", 1)[0].strip() for prompt in head["prompt"]]
+    latencies, with_entities, total = [], 0, 0
+    selector.cache.clear()
+    for context, entity in zip(contexts, head["entity"]):
+        start = time.perf_counter()
+        selector.select(context, entity)
+        latencies.append(time.perf_counter() - start)
+        for doc_id in selector.index.search(tokenize(context), args.k):
+            spans = selector.typed_spans[doc_id]
+            with_entities += bool(any(spans.values()) if entity == JOINT_ENTITY else spans.get(entity))
+            total += 1
+
+    def describe(tokens: np.ndarray) -> str:
+        return f"mean={tokens.mean():7.1f} p95={np.percentile(tokens, 95):7.1f} max={tokens.max():6d}"
+
+    print(f"rows={rows}")
+    print(f"static  prompt tokens: {describe(static_tokens)}  render {static_rate:9.0f} rows/s")
+    print(
+        f"dynamic prompt tokens: {describe(dynamic_tokens)}  render {cold_rate:9.0f} rows/s cold, "
+        f"{warm_rate:9.0f} rows/s warm"
+    )
+    print(f"prompt tokens saved: {1 - dynamic_tokens.mean() / static_tokens.mean():.1%} of the mean")
+    print(
+        f"selection latency: mean={np.mean(latencies) * 1e6:.0f}us p95={np.percentile(latencies, 95) * 1e6:.0f}us, "
+        f"{with_entities / max(total, 1):.1%} of retrieved examples show an entity of the prompt's type"
+    )
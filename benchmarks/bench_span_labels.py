@@ -0,0 +1,81 @@
+"""
+    Compares data_loading.label_spans against the per-span re-split loop that
+    MRC_NER._post_process used before, on synthetic CoNLL-style records.
+
+    Run from the repository root with `python -m benchmarks.bench_span_labels`.
+"""
+import time
+import random
+import argparse
+
+from typing import List
+from data_loading import label_spans
+
+
+def legacy_label_spans(context: str, span_position: List[str], string_mode: bool) -> str:
+    label = context
+    entities = []
+
+    for pos in span_position:
+        start, end = pos.split(";")
+        words = label.split(" ")
+        temp_entity = words[int(start) : int(end) + 1]
+        words[int(start)] = "<entity>" + words[int(start)]
+        words[int(end)] = words[int(end)] + "</entity>"
+        label = " ".join(words)
+        entities.append(" ".join(temp_entity))
+
+    if not string_mode:
+        label = " , ".join(entities)
+        label = "<entity>" + label + "</entity>"
+    return label
+
+
+def make_records(num_records: int, num_words: int, span_density: float, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    records = []
+    for _ in range(num_records):
+        words = [f"w{rng.randrange(10_000)}" for _ in range(num_words)]
+        spans, i = [], 0
+        while i < num_words:
+            if rng.random() < span_density:
+                end = min(num_words - 1, i + rng.randrange(3))
+                spans.append(f"{i};{end}")
+                i = end + 2
+            else:
+                i += 1
+        records.append((" ".join(words), spans))
+    return records
+
+
+def bench(fn, records, string_mode: bool) -> float:
+    start = time.perf_counter()
+    for context, spans in records:
+        fn(context, spans, string_mode)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=5_000)
+    parser.add_argument("--words", type=int, nargs="+", default=[15, 60, 250])
+    parser.add_argument("--span-density", type=float, default=0.2)
+    args = parser.parse_args()
+
+    for num_words in args.words:
+        records = make_records(args.records, num_words, args.span_density)
+        # also cover overlapping, unsorted and negative spans, which take the general path
+        records.append(("a b c d e", ["0;2", "1;3", "2;2"]))
+        records.append(("a b c d e", ["3;4", "0;1", "-1;-1"]))
+
+        for string_mode in (False, True):
+            for context, spans in records:
+                assert legacy_label_spans(context, spans, string_mode) == label_spans(context, spans, string_mode)
+
+            legacy = bench(legacy_label_spans, records, string_mode)
+            single_pass = bench(label_spans, records, string_mode)
+            print(
+                f"words={num_words:<4} string_mode={string_mode!s:<5} "
+                f"legacy={legacy * 1e3:8.1f}ms single_pass={single_pass * 1e3:8.1f}ms "
+                f"speedup={legacy / single_pass:5.2f}x"
+            )
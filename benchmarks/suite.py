@@ -0,0 +1,259 @@
+"""
+    CPU-only benchmark suite for the data, reward and metric hot paths: MRC_NER
+    post-processing, load_conll_dataset (cold and cached), every reward function in
+    rewards.py, evaluate_predictions and MetricsAccumulator.
+
+    Everything runs on a synthetic CoNLL-style corpus written to a temporary directory,
+    parameterised by sentence count, span density (the fraction of words inside an
+    entity) and maximum entity length, and on synthetic completion groups parameterised
+    by group size and duplicate rate. No model, GPU or network is needed.
+
+    Each component reports the best wall time over --repeats runs, its throughput, and
+    its peak Python heap (tracemalloc, measured in a separate run; Arrow buffers are
+    allocated outside the Python heap and are not counted). Results are written in the
+    format of profiling.StageTimer.export, so `--baseline` compares them with
+    profiling.compare_timings, and `--save-baseline` stores a new baseline.
+
+    Run from the repository root with `python -m benchmarks.suite`.
+"""
+import os
+os.environ.setdefault("HF_DATASETS_OFFLINE", "1")
+
+import gc
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from typing import Callable, Dict, List, Tuple
+from data_loading import LABEL_TO_STR, MRC_NER, label_spans, load_conll_dataset
+from metrics import MetricsAccumulator, evaluate_predictions, extract_entities_from_xml
+from profiling import compare_timings
+from rewards import (
+    answer_entities,
+    correctness_reward_func,
+    negative_entity_correctness_reward_func,
+    positive_entity_correctness_reward_func,
+    soft_format_reward_func,
+)
+
+BASELINE_PATH = "benchmarks/baseline.json"
+WORDS = [f"w{i}" for i in range(2000)]
+ENTITY_WORDS = [f"E{i}" for i in range(5000)]
+
+
+def make_corpus(num_sentences: int, span_density: float, entity_length: int, seed: int = 0) -> List[dict]:
+    """Raw MRC records, one per sentence and entity type, like data/conll03/mrc-ner.*"""
+    rng = random.Random(seed)
+    records = []
+    for sentence_id in range(num_sentences):
+        length = rng.randint(8, 40)
+        words = [rng.choice(WORDS) for _ in range(length)]
+        spans = {label: [] for label in LABEL_TO_STR}
+        position = 0
+        while position < length:
+            span_length = rng.randint(1, entity_length)
+            if rng.random() < span_density / max(span_length, 1) and position + span_length <= length:
+                label = rng.choice(list(LABEL_TO_STR))
+                words[position : position + span_length] = [rng.choice(ENTITY_WORDS) for _ in range(span_length)]
+                spans[label].append((position, position + span_length - 1))
+                position += span_length + 1
+            else:
+                position += 1
+        context = " ".join(words)
+        for label, query in LABEL_TO_STR.items():
+            records.append({
+                "context": context,
+                "end_position": [end for _, end in spans[label]],
+                "entity_label": label,
+                "impossible": not spans[label],
+                "qas_id": f"{sentence_id}.{label}",
+                "query": f"{query.lower()} entities",
+                "span_position": [f"{start};{end}" for start, end in spans[label]],
+                "start_position": [start for start, _ in spans[label]],
+            })
+    return records
+
+
+def make_completions(records: List[dict], num_prompts: int, group_size: int, duplicate_rate: float, seed: int = 0):
+    """Prompts, completions and answers for `num_prompts` groups of `group_size` completions"""
+    rng = random.Random(seed)
+    pool = [record for record in records if record["span_position"]] or records
+    prompts, completions, answers = [], [], []
+    for _ in range(num_prompts):
+        record = rng.choice(pool)
+        answer = label_spans(record["context"], record["span_position"], False)
+        truth = extract_entities_from_xml(answer)
+        group = []
+        for _ in range(group_size):
+            if group and rng.random() < duplicate_rate:
+                text = rng.choice(group)
+            else:
+                out = rng.sample(truth, rng.randint(0, len(truth))) + rng.sample(ENTITY_WORDS, rng.randint(0, 2))
+                think = "<think> reasoning </think> " if rng.random() < 0.9 else ""
+                text = f"{think}<entity>{', '.join(out)}</entity>"
+            group.append(text)
+        for text in group:
+            prompts.append([{"role": "user", "content": record["context"]}])
+            completions.append([{"role": "assistant", "content": text}])
+            answers.append(answer)
+    return prompts, completions, answers
+
+
+def reward_bench(func: Callable, prompts, completions, answers) -> Callable[[], int]:
+    def run() -> int:
+        # fresh lists and caches, so the per-step memoisation in rewards.py starts cold
+        answer_entities.cache_clear()
+        func(prompts=list(prompts), completions=list(completions), answer=list(answers))
+        return len(completions)
+    return run
+
+
+def measure(run: Callable[[], int], repeats: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        items = run()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "calls": repeats,
+        "total_s": sum(times),
+        "mean_s": best,
+        "max_s": max(times),
+        "items": items,
+        "items_per_s": items / best if best else float("inf"),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def build_components(args, workdir: str) -> List[Tuple[str, Callable[[], int]]]:
+    records = make_corpus(args.sentences, args.span_density, args.entity_length)
+    corpus_path = os.path.join(workdir, "mrc-ner.synthetic")
+    with open(corpus_path, "w") as f:
+        json.dump(records, f)
+    num_rows = sum(1 for record in records if record["start_position"])
+    cache_root = os.path.join(workdir, "cache")
+
+    def post_process() -> int:
+        return len(MRC_NER(corpus_path, True, False).dataset)
+
+    def load_cold() -> int:
+        shutil.rmtree(cache_root, ignore_errors=True)
+        data = load_conll_dataset(corpus_path, compact=True, cache_dir=cache_root)
+        for start in range(0, len(data), 1000):
+            data[start : start + 1000]
+        return len(data)
+
+    def load_warm() -> int:
+        data = load_conll_dataset(corpus_path, compact=True, cache_dir=cache_root)
+        for start in range(0, len(data), 1000):
+            data[start : start + 1000]
+        return len(data)
+
+    prompts, completions, answers = make_completions(
+        records, args.prompts, args.group_size, args.duplicate_rate
+    )
+    samples = [extract_entities_from_xml(completion[0]["content"]) for completion in completions]
+    truths = [extract_entities_from_xml(answer) for answer in answers]
+
+    def evaluate() -> int:
+        evaluate_predictions(samples, truths)
+        return len(samples)
+
+    def accumulate() -> int:
+        accumulator = MetricsAccumulator(1, tuple(LABEL_TO_STR.values()))
+        accumulator.update([[sample] for sample in samples], truths, ["Person"] * len(samples))
+        accumulator.metrics()
+        return len(samples)
+
+    components = [
+        ("data/mrc_ner_post_process", post_process),
+        ("data/load_conll_dataset_cold", load_cold),
+        ("data/load_conll_dataset_warm", load_warm),
+    ]
+    for func in (
+        soft_format_reward_func,
+        positive_entity_correctness_reward_func,
+        negative_entity_correctness_reward_func,
+        correctness_reward_func,
+    ):
+        components.append((f"reward/{func.__name__}", reward_bench(func, prompts, completions, answers)))
+    components += [
+        ("metrics/evaluate_predictions", evaluate),
+        ("metrics/accumulator", accumulate),
+    ]
+    print(f"Synthetic corpus: {len(records)} records, {num_rows} with entities; {len(completions)} completions")
+    return components
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sentences", type=int, default=2000)
+    parser.add_argument("--span-density", type=float, default=0.15, help="fraction of words inside an entity")
+    parser.add_argument("--entity-length", type=int, default=3, help="maximum words per entity")
+    parser.add_argument("--prompts", type=int, default=256)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--duplicate-rate", type=float, default=0.25, help="chance a completion repeats one of its group")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", default=None, help="run only components whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed growth of time and peak memory")
+    parser.add_argument("--output", default=None, help="also write the results here")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ner-bench-")
+    try:
+        results = {}
+        for name, run in build_components(args, workdir):
+            if args.only and args.only not in name:
+                continue
+            results[name] = measure(run, args.repeats)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'component':<52} {'best ms':>10} {'items/s':>12} {'peak MB':>9}")
+    for name, row in results.items():
+        print(f"{name:<52} {row['mean_s'] * 1e3:>10.2f} {row['items_per_s']:>12.0f} {row['peak_mb']:>9.1f}")
+
+    # only the workload parameters need to match for timings to be comparable
+    workload = ("sentences", "span_density", "entity_length", "prompts", "group_size", "duplicate_rate")
+    report = {"meta": {key: getattr(args, key) for key in workload}, "stages": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"] != report["meta"]:
+            print(f"Warning: baseline was recorded with different parameters: {baseline['meta']}")
+        regressions = compare_timings(baseline, report, args.tolerance)
+        for name, row in results.items():
+            old = baseline["stages"].get(name)
+            if old is not None and row["peak_mb"] > old["peak_mb"] * (1 + args.tolerance) + 1:
+                regressions.append(f"{name}: peak {old['peak_mb']:.1f}MB -> {row['peak_mb']:.1f}MB")
+        for line in regressions:
+            print(f"Regressed: {line}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No component regressed beyond {args.tolerance:.0%} of {args.baseline}")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to store one")
@@ -0,0 +1,66 @@
+import time
+
+from typing import Dict, Optional, Protocol
+
+from transformers import Trainer, TrainerCallback
+from profiling import TIMER, StageTimer
+
+
+class MetricsSource(Protocol):
+    def pop_metrics(self) -> Dict[str, float]:
+        """Metrics accumulated since the previous call"""
+        ...
+
+
+class MetricsCallback(TrainerCallback):
+    """
+        Merges the metrics of every source into each log entry, so they reach wandb
+        next to the trainer's own loss and reward metrics.
+    """
+    def __init__(self, *sources: MetricsSource):
+        self.sources = sources
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None:
+            return
+        for source in self.sources:
+            logs.update(source.pop_metrics())
+
+
+class StepTimingCallback(TrainerCallback):
+    """
+        Times every optimisation step ("train/step") and its optimizer update
+        ("train/optimizer") into a StageTimer. Pass the timer to add_metrics_callback so
+        the stage times reach the logs. Everything else in a step (generation, reward
+        scoring, forward and backward) is timed by the stages it runs through.
+    """
+    def __init__(self, timer: StageTimer = TIMER):
+        self.timer = timer
+        self._step_start: Optional[float] = None
+        self._optimizer_start: Optional[float] = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._optimizer_start = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._optimizer_start is not None:
+            self.timer.record("train/optimizer", time.perf_counter() - self._optimizer_start)
+            self._optimizer_start = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._step_start is not None:
+            self.timer.record("train/step", time.perf_counter() - self._step_start)
+            self._step_start = None
+
+
+def add_metrics_callback(trainer: Trainer, *sources: MetricsSource) -> MetricsCallback:
+    """
+        Registers a MetricsCallback ahead of the reporting callbacks. Callbacks passed to
+        the Trainer constructor run after WandbCallback and would miss the log entry.
+    """
+    callback = MetricsCallback(*sources)
+    trainer.callback_handler.callbacks.insert(0, callback)
+    return callback
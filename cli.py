@@ -0,0 +1,174 @@
+"""
+    Single entry point for the pipeline:
+
+        python cli.py prepare-data --config configs/conll03.json
+        python cli.py train        --config configs/conll03.json
+        python cli.py generate     --config configs/conll03.json
+        python cli.py score        --config configs/conll03.json --set score.allow_partial=true
+
+    Every subcommand reads its own section of the JSON config file, and `--set
+    section.key=value` overrides single entries (values are parsed as JSON, falling back
+    to plain strings). Nested options take more dots, e.g. `--set
+    train.grpo.learning_rate=1e-6`. Sections are named after the commands, with underscores
+    (prepare_data, train, generate, score).
+
+    Frameworks are imported inside the subcommands that use them: prepare-data needs
+    only pyarrow (and transformers with a tokenizer), score only numpy, so neither pays
+    for torch, datasets or vllm.
+"""
+import os
+import json
+import argparse
+
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class PrepareConfig:
+    data_paths: List[str] = field(default_factory=lambda: ["data/conll03/mrc-ner.train", "data/conll03/mrc-ner.test"])
+    cache_dir: str = "cache/conll"
+    # also tokenise the rendered prompts into the PromptTokenStore cache
+    tokenizer: Optional[str] = None
+    max_prompt_length: int = 2048
+    joint: bool = False
+    include_examples: bool = True
+
+
+@dataclass
+class GenerateConfig:
+    data_path: str = "data/conll03/mrc-ner.test"
+    cache_dir: str = "cache/conll"
+    out_dir: str = "results/generations"
+    model: str = "Qwen/Qwen2.5-1.5B-Instruct"
+    num_shards: int = 16
+    rank: int = 0
+    world_size: int = 1
+    chunk_size: int = 256
+    num_samples: int = 16
+    temperature: float = 0.0
+    joint: bool = False
+    # CPU stand-in for the engine, see sharded_eval.stub_generate
+    stub: bool = False
+
+
+@dataclass
+class ScoreConfig:
+    out_dir: str = "results/generations"
+    allow_partial: bool = False
+    # recompute from the saved completions instead of merging the saved shard states
+    rescore: bool = True
+
+
+def build(cls, section: Dict[str, Any]):
+    """A config dataclass from a config section, rejecting keys it does not have"""
+    names = {f.name for f in fields(cls)}
+    unknown = sorted(set(section) - names)
+    if unknown:
+        raise ValueError(f"Unknown {cls.__name__} options {unknown}; expected some of {sorted(names)}")
+    return cls(**section)
+
+
+def load_config(path: Optional[str], overrides: List[str]) -> Dict[str, Dict[str, Any]]:
+    config: Dict[str, Dict[str, Any]] = {}
+    if path is not None:
+        with open(path) as f:
+            config = json.load(f)
+    for override in overrides:
+        key, sep, raw = override.partition("=")
+        section, dot, name = key.partition(".")
+        if not sep or not dot:
+            raise ValueError(f"Overrides look like section.key=value, got {override!r}")
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            value = raw
+        # further dots reach into nested options, e.g. train.grpo.learning_rate
+        target = config.setdefault(section, {})
+        *parents, name = name.split(".")
+        for parent in parents:
+            target = target.setdefault(parent, {})
+            if not isinstance(target, dict):
+                raise ValueError(f"Cannot set {override!r}: {parent} is not a section of options")
+        target[name] = value
+    return config
+
+
+def prepare_data(config: PrepareConfig):
+    from data_loading import CompactNER
+
+    for path in config.data_paths:
+        data = CompactNER(path, True, cache_dir=config.cache_dir)
+        print(f"Prepared {data.num_rows} rows of {path}")
+        if config.tokenizer is None:
+            continue
+
+        from transformers import AutoTokenizer
+        from data_loading import load_conll_dataset
+        from prompt_store import PromptTokenStore
+
+        tokenizer = AutoTokenizer.from_pretrained(config.tokenizer)
+        dataset = load_conll_dataset(
+            path, include_examples=config.include_examples, compact=True, cache_dir=config.cache_dir, joint=config.joint
+        )
+        PromptTokenStore(dataset, tokenizer, config.max_prompt_length, cache_dir=config.cache_dir)
+
+
+def train(section: Dict[str, Any]):
+    from train import TrainingArgs, main
+
+    main(build(TrainingArgs, section))
+
+
+def generate(config: GenerateConfig):
+    from functools import partial
+    from data_loading import load_conll_dataset
+    from sharded_eval import ShardedEvalRunner, stub_generate
+
+    dataset = load_conll_dataset(
+        config.data_path, include_examples=True, compact=True, cache_dir=config.cache_dir, joint=config.joint
+    )
+    if config.stub:
+        generate_fn = partial(stub_generate, joint=config.joint)
+    else:
+        from eval import load_llm, make_generate_fn
+
+        generate_fn = make_generate_fn(load_llm(config.model), config.num_samples, config.temperature, config.joint)
+
+    runner = ShardedEvalRunner(dataset, generate_fn, config.out_dir, config.num_shards, config.chunk_size)
+    runner.run(config.rank, config.world_size)
+    print(f"Generations are in {config.out_dir}; score them with `python cli.py score`")
+
+
+def score(config: ScoreConfig):
+    from sharded_eval import ShardedEvalRunner, write_metrics
+
+    runner = ShardedEvalRunner.from_manifest(config.out_dir)
+    accumulator = runner.rescore(config.allow_partial) if config.rescore else runner.merge(config.allow_partial)
+
+    print(f"Evaluation Metrics: {accumulator.summary()}")
+    for entity_type, entity_metrics in accumulator.metrics()["per_entity"].items():
+        print(f"{entity_type} F1: {entity_metrics['f1_mean']:.4f} (std {entity_metrics['f1_std']:.4f})")
+    write_metrics(accumulator, os.path.join(config.out_dir, "metrics.json"))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="NER with GRPO")
+    parser.add_argument("command", choices=["prepare-data", "train", "generate", "score"])
+    parser.add_argument("--config", default=None, help="JSON file with one section per command")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="SECTION.KEY=VALUE")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = load_config(args.config, args.overrides)
+
+    if args.command == "prepare-data":
+        prepare_data(build(PrepareConfig, config.get("prepare_data", {})))
+    elif args.command == "train":
+        train(config.get("train", {}))
+    elif args.command == "generate":
+        generate(build(GenerateConfig, config.get("generate", {})))
+    else:
+        score(build(ScoreConfig, config.get("score", {})))
@@ -1,7 +1,32 @@
+import os
 import json
-import pandas as pd
-from datasets import Dataset
-from utils import ENTITY_EXAMPLES
+import hashlib
+import pyarrow as pa
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+from typing import TYPE_CHECKING, Dict, Iterator, List, Tuple
+from utils import ENTITY_EXAMPLES, JOINT_EXAMPLES
+from profiling import timed
+
+if TYPE_CHECKING:
+    # datasets takes about a second to import, so it is only imported where rows are read
+    from datasets import Dataset
+
+CACHE_DIR = "cache/conll"
+CACHE_VERSION = "2"
+# below this many records, MRC_NER labels in process even when num_proc > 1
+MIN_PARALLEL_RECORDS = 50_000
+
+LABEL_TO_STR = {
+    "PER": "Person",
+    "LOC": "Location",
+    "ORG": "Organization",
+    "MISC": "Miscellaneous"
+}
+
+# entity column value of joint rows, which ask for every entity type at once
+JOINT_ENTITY = "All"
 
 SYSTEM_PROMPT = """
 A conversation between User and Assistant. The User provides a string of words. The task of the Assistant is to identify all the {entity_label} entities 
@@ -41,7 +66,55 @@ User: {context}
 Assistant: 
 """
 
-def load_conll_dataset(file_path: str, num_proc: int = 1, include_examples: bool = True) -> Dataset:
+JOINT_SYSTEM_PROMPT = """
+A conversation between User and Assistant. The User provides a string of words. The task of the Assistant is to identify all the Person, Location, Organization 
+and Miscellaneous entities in the given string and return the entities of each type surrounded by the tag of that type.
+{descriptions}
+
+The Assistant should reason about each entity class and each string/word in the given query and which of the words might belong to which class. 
+It would also be important to pay attention to the context.
+
+The reasoning process should be enclosed within <think> </think> tags, and the answer within <entities> </entities> tags, with one tag per entity type inside it.
+i.e <think> reasoning process here </think> <entities> <person> comma separated list of words that are persons</person> <location> comma separated list of words that are locations</location> <organization> comma separated list of words that are organizations</organization> <miscellaneous> comma separated list of words that are miscellaneous entities</miscellaneous> </entities>
+
+If none of the words match an entity type, simply return the tag of that type with nothing in between.
+If multiple words match an entity type, return them, separated by a comma, in the tag of that type.
+
+{example}
+
+User: {context}
+Assistant: 
+"""
+
+JOINT_EVAL_SYSTEM_PROMPT = """
+A conversation between User and Assistant. The User provides a string of words. The task of the Assistant is to identify all the Person, Location, Organization 
+and Miscellaneous entities in the given string and return the entities of each type surrounded by the tag of that type.
+{descriptions}
+
+The Assistant should reason about each entity class and each string/word in the given query and which of the words might belong to which class. 
+It would also be important to pay attention to the context.
+
+The reasoning process should be enclosed within <think> </think> tags, and the answer within <entities> </entities> tags, with one tag per entity type inside it.
+i.e <think> reasoning process here </think> <entities> <person> comma separated list of words that are persons</person> <location> comma separated list of words that are locations</location> <organization> comma separated list of words that are organizations</organization> <miscellaneous> comma separated list of words that are miscellaneous entities</miscellaneous> </entities>
+
+If none of the words match an entity type, simply return the tag of that type with nothing in between.
+If multiple words match an entity type, return them, separated by a comma, in the tag of that type.
+
+User: {context}
+Assistant: 
+"""
+
+@timed("data/load_conll_dataset")
+def load_conll_dataset(
+    file_path: str,
+    num_proc: int = 1,
+    include_examples: bool = True,
+    streaming: bool = False,
+    cache_dir: str = CACHE_DIR,
+    compact: bool = False,
+    joint: bool = False,
+    example_selector=None,
+) -> "Dataset":
     """
         Loads the CoNLL-2003 dataset by instantiating the MRC_NER class and formatting the
         data to the desired input format. 
@@ -50,16 +123,37 @@ def load_conll_dataset(file_path: str, num_proc: int = 1, include_examples: bool
             file_path (str): the local file path of the CoNLL dataset
             include_examples (bool): if to include few-shot examples or not. 
                 If set to false, then the eval prompt is loaded and returned.
+            streaming (bool): if set, the file is parsed record by record into a
+                memory-mapped Arrow cache under `cache_dir`, which is reused on later runs.
+            cache_dir (str): where the streaming cache files are written.
+            compact (bool): if set, the rows come from CompactNER and the prompts are
+                rendered on access instead of being stored. Implies streaming.
+            joint (bool): if set, there is one row per sentence asking for all four entity
+                types at once (JOINT_SYSTEM_PROMPT) instead of one row per entity type.
+                Implies compact.
+            example_selector (FewShotSelector): if given, the few-shot examples of every
+                prompt are picked for its context by the selector instead of being the
+                static ENTITY_EXAMPLES / JOINT_EXAMPLES block.
 
         Returns:
             A dataset.Dataset object
     """
-    data = MRC_NER(file_path, True, False).get_dataset()
+    if joint:
+        return CompactNER(file_path, True, cache_dir=cache_dir).get_joint_dataset(include_examples, example_selector)
+    if compact:
+        return CompactNER(file_path, True, cache_dir=cache_dir).get_dataset(include_examples, example_selector)
+
+    data = MRC_NER(
+        file_path, True, False, streaming=streaming, cache_dir=cache_dir, num_proc=num_proc
+    ).get_dataset()
     
     def process_example(example):
-        example_prompt = ENTITY_EXAMPLES.get(
-            example["entity"]
-        )
+        if example_selector is not None:
+            example_prompt = example_selector.select(example["context"], example["entity"])
+        else:
+            example_prompt = ENTITY_EXAMPLES.get(
+                example["entity"]
+            )
 
         if include_examples:
             return {
@@ -89,6 +183,195 @@ def load_conll_dataset(file_path: str, num_proc: int = 1, include_examples: bool
         num_proc=num_proc,
     )
 
+def iter_json_records(file_path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+        Yields the objects of a top-level JSON array one at a time, so the whole
+        file never has to be held in memory.
+
+        Args:
+            file_path (str): path to a file containing a JSON array of objects
+            chunk_size (int): number of characters read from disk at a time
+
+        Returns:
+            An iterator over the decoded records
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        started = False
+
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+                pos += 1
+
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"{file_path} ended before the closing ']'")
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+                continue
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"{file_path} does not contain a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the record straddles the chunk boundary, so keep its head and read on
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            yield record
+            pos = end
+
+
+def file_fingerprint(file_path: str, **options) -> str:
+    """Hashes the file contents together with the loader options that affect the output."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(json.dumps({"version": CACHE_VERSION, **options}, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def label_spans(context: str, span_position: List[str], string_mode: bool) -> str:
+    """
+        Converts the "start;end" word spans of one record into its label string.
+
+        The context is split once and every span is applied in a single pass. Sorted,
+        disjoint spans (the CoNLL case) are sliced straight out of the words; anything
+        else goes through _label_overlapping_spans, which reproduces what applying each
+        span to the already-tagged string in turn would give.
+
+        Args:
+            context (str): the sentence, with words separated by single spaces
+            span_position (List[str]): inclusive word spans formatted as "start;end"
+            string_mode (bool): if set, the whole context is returned with the entities
+                tagged in place. Otherwise the entities are returned comma separated
+                inside a single entity tag.
+
+        Returns:
+            The label string
+    """
+    spans = [tuple(map(int, pos.split(";"))) for pos in span_position]
+    return label_word_spans(context.split(" "), spans, string_mode)
+
+
+def label_word_spans(words: List[str], spans: List[Tuple[int, int]], string_mode: bool) -> str:
+    """label_spans for an already split context and integer (start, end) spans."""
+    disjoint = all(0 <= start <= end < len(words) for start, end in spans) and all(
+        prev_end < start for (_, prev_end), (start, _) in zip(spans, spans[1:])
+    )
+    if not disjoint:
+        return _label_overlapping_spans(words, spans, string_mode)
+
+    if not string_mode:
+        entities = [" ".join(words[start : end + 1]) for start, end in spans]
+        return "<entity>" + " , ".join(entities) + "</entity>"
+
+    words = list(words)
+    for start, end in spans:
+        words[start] = "<entity>" + words[start]
+        words[end] = words[end] + "</entity>"
+    return " ".join(words)
+
+
+def label_joint_spans(words: List[str], typed_spans: Dict[str, List[Tuple[int, int]]]) -> str:
+    """
+        The joint answer string: one tag per entity type, named after the type and holding
+        what label_word_spans would put in that type's entity tag, inside an entities tag.
+        Types without spans get an empty tag.
+    """
+    sections = []
+    for entity in LABEL_TO_STR.values():
+        content = label_word_spans(words, typed_spans.get(entity, []), False)[len("<entity>"):-len("</entity>")]
+        sections.append(f"<{entity.lower()}>{content}</{entity.lower()}>")
+    return "<entities> " + " ".join(sections) + " </entities>"
+
+
+def _label_overlapping_spans(words: List[str], spans: List[Tuple[int, int]], string_mode: bool) -> str:
+    """
+        General form of label_spans. Tags are tracked as per-word open/close counts, so
+        an entity that overlaps an earlier span picks up that span's tags, exactly as
+        the original re-split loop did.
+    """
+    positions = range(len(words))
+    opened = [0] * len(words)
+    closed = [0] * len(words)
+    entities = []
+
+    def render(i: int) -> str:
+        return "<entity>" * opened[i] + words[i] + "</entity>" * closed[i]
+
+    for start, end in spans:
+        entities.append(" ".join([render(i) for i in positions[start : end + 1]]))
+        opened[start] += 1
+        closed[end] += 1
+
+    if string_mode:
+        return " ".join([render(i) for i in positions])
+    return "<entity>" + " , ".join(entities) + "</entity>"
+
+
+def label_records(batch: Dict[str, list], string_mode: bool, label_to_str: Dict[str, str]) -> Dict[str, list]:
+    """Turns a columnar batch of raw MRC records into processed rows."""
+    return {
+        "context": batch["context"],
+        "entity": [label_to_str[label] for label in batch["entity_label"]],
+        "query": batch["query"],
+        "labels": [
+            label_spans(context, spans, string_mode)
+            for context, spans in zip(batch["context"], batch["span_position"])
+        ],
+    }
+
+
+def label_batches(label_fn, batches: Iterator[Dict[str, list]], num_proc: int) -> Iterator[Dict[str, list]]:
+    """
+        Applies label_fn to every batch, in order. With num_proc > 1 the batches go to a
+        process pool, with at most 2 * num_proc of them in flight, so reading the input
+        never runs more than a few batches ahead of the workers.
+    """
+    if num_proc <= 1:
+        yield from map(label_fn, batches)
+        return
+
+    with Pool(num_proc) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(label_fn, (batch,)))
+            if len(pending) >= 2 * num_proc:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _record_batches(records: Iterator[dict], batch_size: int) -> Iterator[Dict[str, list]]:
+    """Groups records into columnar batches holding only the fields label_records reads."""
+    keys = ("context", "entity_label", "query", "span_position")
+    batch = {key: [] for key in keys}
+    for item in records:
+        for key in keys:
+            batch[key].append(item[key])
+        if len(batch["context"]) == batch_size:
+            yield batch
+            batch = {key: [] for key in keys}
+    if batch["context"]:
+        yield batch
+
+
 class MRC_NER:
     """
         This class loads the dataset from local and formats it in a way that's 
@@ -96,56 +379,368 @@ class MRC_NER:
 
         Heavily modified but took some inspiration from https://github.com/ShannonAI/mrc-for-flat-nested-ner/blob/master/datasets/mrc_ner_dataset.py
     """
-    def __init__(self, file_path: str, possible_only: bool, string_mode: bool):
+    schema = pa.schema([
+        ("context", pa.string()),
+        ("entity", pa.string()),
+        ("query", pa.string()),
+        ("labels", pa.string()),
+    ])
+
+    def __init__(
+        self,
+        file_path: str,
+        possible_only: bool,
+        string_mode: bool,
+        streaming: bool = False,
+        cache_dir: str = CACHE_DIR,
+        batch_size: int = 1000,
+        num_proc: int = 1,
+    ):
         self.file_path = file_path
         self.possible_only = possible_only
         self.string_mode = string_mode
-        
+        self.batch_size = batch_size
+        self.num_proc = num_proc
+
+        self.label_to_str = LABEL_TO_STR
+
+        if streaming:
+            self._load_cached(cache_dir)
+            return
+
         self.all_data = json.load(open(file_path, encoding="utf-8"))
         if possible_only:
             self.all_data = [
                 x for x in self.all_data if x["start_position"]
             ]
 
-        self.label_to_str  = {
-            "PER": "Person",
-            "LOC": "Location",
-            "ORG": "Organization",
-            "MISC": "Miscellaneous"
-        }
-
         self._post_process()
 
+    def _label_fn(self, ):
+        return partial(label_records, string_mode=self.string_mode, label_to_str=self.label_to_str)
+
     def _post_process(self, ):
-        self.processed_data = []
-        for item in self.all_data:
-            label = item["context"]
-            entities = []
-            
-            for pos in item["span_position"]:
-                start, end = pos.split(";")
-                words = label.split(" ")
-                temp_entity = words[int(start) : int(end) + 1]
-                words[int(start)] = "<entity>" + words[int(start)]
-                words[int(end)] = words[int(end)] + "</entity>" 
-                label = " ".join(words)
-                entities.append(" ".join(temp_entity))
-
-            if not self.string_mode:
-                label = " , ".join(entities)
-                label = "<entity>" + label + "</entity>"
-
-            entry = {
-                "context": item["context"],
-                "entity": self.label_to_str[item["entity_label"]],
-                "query": item["query"],
-                "labels": label
-            }
-            self.processed_data.append(entry)
+        from datasets import Dataset
 
-        print(f"All {len(self.processed_data)} has been processed")
-        self.dataset = Dataset.from_pandas(pd.DataFrame(self.processed_data))
+        # labelling is cheap next to pickling records to workers, so small files stay in process
+        num_proc = self.num_proc if len(self.all_data) >= MIN_PARALLEL_RECORDS else 1
+        processed = {name: [] for name in self.schema.names}
+        for batch in label_batches(self._label_fn(), _record_batches(iter(self.all_data), self.batch_size), num_proc):
+            for name, column in batch.items():
+                processed[name].extend(column)
+
+        print(f"All {len(processed['labels'])} has been processed")
+        self.dataset = Dataset.from_dict(processed)
         print(f"Converted {len(self.dataset)} entries to Dataset.")
 
+    def _load_cached(self, cache_dir: str):
+        """
+            Memory-maps the Arrow cache for this file and these options, building it
+            first if no run has done so yet.
+        """
+        fingerprint = file_fingerprint(
+            self.file_path,
+            possible_only=self.possible_only,
+            string_mode=self.string_mode,
+        )
+        name = os.path.basename(self.file_path)
+        cache_path = os.path.join(cache_dir, f"{name}-{fingerprint}.arrow")
+
+        if os.path.exists(cache_path):
+            print(f"Loading cached dataset from {cache_path}")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._write_cache(cache_path)
+
+        from datasets import Dataset
+
+        self.dataset = Dataset.from_file(cache_path)
+        print(f"Converted {len(self.dataset)} entries to Dataset.")
+
+    def _write_cache(self, cache_path: str):
+        """Streams processed records into an Arrow file, one record batch at a time."""
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        num_rows = 0
+
+        records = iter_json_records(self.file_path)
+        if self.possible_only:
+            records = (item for item in records if item["start_position"])
+        batches = _record_batches(records, self.batch_size)
+
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_stream(sink, self.schema) as writer:
+            for processed in label_batches(self._label_fn(), batches, self.num_proc):
+                writer.write_batch(pa.RecordBatch.from_pydict(processed, schema=self.schema))
+                num_rows += len(processed["labels"])
+
+        # concurrent runs may race to build the same cache; whichever finishes last wins
+        os.replace(tmp_path, cache_path)
+        print(f"All {num_rows} has been processed")
+
     def get_dataset(self, ):
-        return self.dataset
\ No newline at end of file
+        return self.dataset
+
+
+TEMPLATES = (SYSTEM_PROMPT, EVAL_SYSTEM_PROMPT)
+JOINT_TEMPLATES = (JOINT_SYSTEM_PROMPT, JOINT_EVAL_SYSTEM_PROMPT)
+ENTITY_LABELS = tuple(LABEL_TO_STR)
+# every template as the (head, tail) around {context}
+TEMPLATE_PARTS = tuple(tuple(template.split("{context}")) for template in TEMPLATES)
+JOINT_TEMPLATE_PARTS = tuple(tuple(template.split("{context}")) for template in JOINT_TEMPLATES)
+# stands in for {example} in cached prefixes when the examples depend on the context
+EXAMPLE_SLOT = "\x00example\x00"
+
+
+def fill_examples(prefix: str, context: str, entity: str, example_selector) -> str:
+    """Puts the selector's examples for this context into a prefix rendered with EXAMPLE_SLOT"""
+    if example_selector is None or EXAMPLE_SLOT not in prefix:
+        return prefix
+    before, after = prefix.split(EXAMPLE_SLOT)
+    return before + example_selector.select(context, entity) + after
+
+
+class PromptRenderer:
+    """
+        Set as the transform of a CompactNER dataset. Turns a batch of sentence/span rows
+        into the same 'prompt' and 'answer' columns load_conll_dataset produces.
+
+        Each template is split at {context}, and the part before it is formatted once per
+        (template, entity, query), so rendering a row is a lookup and two concatenations.
+        With an example_selector, the examples are picked per row and spliced into the
+        cached prefix.
+    """
+    def __init__(self, sentences: pa.Array, queries: List[str], example_selector=None):
+        self.sentences = sentences
+        self.queries = queries
+        self.example_selector = example_selector
+        self._prefixes = {}
+
+    def prefix(self, template_id: int, entity_id: int, query_id: int) -> str:
+        key = (template_id, entity_id, query_id)
+        if key not in self._prefixes:
+            entity = LABEL_TO_STR[ENTITY_LABELS[entity_id]]
+            head, _ = TEMPLATE_PARTS[template_id]
+            self._prefixes[key] = head.format(
+                entity_label=entity,
+                query=self.queries[query_id],
+                example=EXAMPLE_SLOT if self.example_selector is not None else ENTITY_EXAMPLES.get(entity),
+            )
+        return self._prefixes[key]
+
+    def __call__(self, batch: Dict[str, list]) -> Dict[str, list]:
+        contexts = self.sentences.take(pa.array(batch["sentence_id"])).to_pylist()
+        prompts, answers = [], []
+
+        for context, template_id, entity_id, query_id, starts, ends in zip(
+            contexts, batch["template_id"], batch["entity_id"], batch["query_id"], batch["starts"], batch["ends"]
+        ):
+            prefix = fill_examples(
+                self.prefix(template_id, entity_id, query_id), context,
+                LABEL_TO_STR[ENTITY_LABELS[entity_id]], self.example_selector,
+            )
+            content = prefix + context + TEMPLATE_PARTS[template_id][1]
+            prompts.append([{'role': 'user', 'content': content}])
+            answers.append(label_word_spans(context.split(" "), list(zip(starts, ends)), False))
+
+        return {
+            "context": contexts,
+            "entity": [LABEL_TO_STR[ENTITY_LABELS[i]] for i in batch["entity_id"]],
+            "prompt": prompts,
+            "answer": answers,
+        }
+
+
+class JointPromptRenderer:
+    """
+        PromptRenderer for the rows of CompactNER.get_joint_dataset, where each row is a
+        sentence with the spans of every entity type. The prompt asks for all types at
+        once and the answer is built by label_joint_spans.
+    """
+    def __init__(self, sentences: pa.Array, queries: List[str], type_queries: Dict[int, int], example_selector=None):
+        self.sentences = sentences
+        self.queries = queries
+        self.type_queries = type_queries
+        self.example_selector = example_selector
+        self._prefixes = {}
+
+    def prefix(self, template_id: int) -> str:
+        if template_id not in self._prefixes:
+            descriptions = "\n".join(
+                f"DESCRIPTION ({LABEL_TO_STR[ENTITY_LABELS[entity_id]]}): {self.queries[query_id]}"
+                for entity_id, query_id in sorted(self.type_queries.items())
+            )
+            head, _ = JOINT_TEMPLATE_PARTS[template_id]
+            examples = EXAMPLE_SLOT if self.example_selector is not None else JOINT_EXAMPLES
+            self._prefixes[template_id] = head.format(descriptions=descriptions, example=examples)
+        return self._prefixes[template_id]
+
+    def __call__(self, batch: Dict[str, list]) -> Dict[str, list]:
+        contexts = self.sentences.take(pa.array(batch["sentence_id"])).to_pylist()
+        prompts, answers = [], []
+
+        for context, template_id, entity_ids, starts, ends in zip(
+            contexts, batch["template_id"], batch["entity_ids"], batch["starts"], batch["ends"]
+        ):
+            prefix = fill_examples(self.prefix(template_id), context, JOINT_ENTITY, self.example_selector)
+            content = prefix + context + JOINT_TEMPLATE_PARTS[template_id][1]
+            prompts.append([{'role': 'user', 'content': content}])
+            typed_spans = {
+                LABEL_TO_STR[ENTITY_LABELS[entity_id]]: list(zip(type_starts, type_ends))
+                for entity_id, type_starts, type_ends in zip(entity_ids, starts, ends)
+            }
+            answers.append(label_joint_spans(context.split(" "), typed_spans))
+
+        return {
+            "context": contexts,
+            "entity": [JOINT_ENTITY] * len(contexts),
+            "prompt": prompts,
+            "answer": answers,
+        }
+
+
+class CompactNER:
+    """
+        Normalised form of the MRC data. The MRC format repeats every sentence once per
+        entity type, so the sentences are kept once in their own table and each MRC row
+        becomes a sentence id, an entity id, a query id and integer span arrays.
+
+        Both tables are written to memory-mapped Arrow files under `cache_dir`, keyed like
+        the MRC_NER streaming cache, with pyarrow alone. `rows` is opened as a Dataset on
+        first use. Prompts are rendered by PromptRenderer when rows are read.
+    """
+    sentence_schema = pa.schema([("context", pa.string())])
+    row_schema = pa.schema([
+        ("sentence_id", pa.int32()),
+        ("entity_id", pa.int8()),
+        ("query_id", pa.int32()),
+        ("starts", pa.list_(pa.int32())),
+        ("ends", pa.list_(pa.int32())),
+    ])
+
+    def __init__(self, file_path: str, possible_only: bool, cache_dir: str = CACHE_DIR, batch_size: int = 1000):
+        self.file_path = file_path
+        self.possible_only = possible_only
+        self.batch_size = batch_size
+
+        fingerprint = file_fingerprint(file_path, possible_only=possible_only, compact=True)
+        prefix = os.path.join(cache_dir, f"{os.path.basename(file_path)}-{fingerprint}")
+        self.sentence_path = f"{prefix}.sentences.arrow"
+        self.row_path = f"{prefix}.rows.arrow"
+        self.query_path = f"{prefix}.queries.json"
+
+        if all(os.path.exists(p) for p in (self.sentence_path, self.row_path, self.query_path)):
+            print(f"Loading cached dataset from {prefix}.*")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._write_cache()
+
+        with open(self.query_path, encoding="utf-8") as f:
+            self.queries = json.load(f)
+        self.sentences = pa.ipc.open_stream(pa.memory_map(self.sentence_path)).read_all().column("context")
+        self.num_rows = pa.ipc.open_stream(pa.memory_map(self.row_path)).read_all().num_rows
+        self._rows = None
+        print(f"Converted {self.num_rows} entries over {len(self.sentences)} sentences to Dataset.")
+
+    @property
+    def rows(self, ) -> "Dataset":
+        if self._rows is None:
+            from datasets import Dataset
+
+            self._rows = Dataset.from_file(self.row_path)
+        return self._rows
+
+    def _write_cache(self, ):
+        sentence_ids, query_ids = {}, {}
+        sentences, rows = [], {name: [] for name in self.row_schema.names}
+        entity_ids = {label: i for i, label in enumerate(ENTITY_LABELS)}
+        tmp = f".{os.getpid()}.tmp"
+
+        with pa.OSFile(self.sentence_path + tmp, "wb") as sentence_sink, \
+                pa.OSFile(self.row_path + tmp, "wb") as row_sink, \
+                pa.ipc.new_stream(sentence_sink, self.sentence_schema) as sentence_writer, \
+                pa.ipc.new_stream(row_sink, self.row_schema) as row_writer:
+
+            def flush():
+                if sentences:
+                    sentence_writer.write_batch(pa.RecordBatch.from_pydict({"context": sentences}, schema=self.sentence_schema))
+                    sentences.clear()
+                if rows["sentence_id"]:
+                    row_writer.write_batch(pa.RecordBatch.from_pydict(rows, schema=self.row_schema))
+                    for column in rows.values():
+                        column.clear()
+
+            for item in iter_json_records(self.file_path):
+                if self.possible_only and not item["start_position"]:
+                    continue
+                # qas_id is "<sentence>.<type>"; equal contexts of different sentences stay apart
+                sentence = item["qas_id"].split(".", 1)[0] if "qas_id" in item else item["context"]
+                if sentence not in sentence_ids:
+                    sentence_ids[sentence] = len(sentence_ids)
+                    sentences.append(item["context"])
+                if item["query"] not in query_ids:
+                    query_ids[item["query"]] = len(query_ids)
+
+                spans = [tuple(map(int, pos.split(";"))) for pos in item["span_position"]]
+                rows["sentence_id"].append(sentence_ids[sentence])
+                rows["entity_id"].append(entity_ids[item["entity_label"]])
+                rows["query_id"].append(query_ids[item["query"]])
+                rows["starts"].append([start for start, _ in spans])
+                rows["ends"].append([end for _, end in spans])
+
+                if len(rows["sentence_id"]) == self.batch_size:
+                    flush()
+            flush()
+
+        with open(self.query_path + tmp, "w", encoding="utf-8") as f:
+            json.dump(list(query_ids), f)
+
+        for path in (self.sentence_path, self.row_path, self.query_path):
+            os.replace(path + tmp, path)
+        print(f"All {len(sentence_ids)} sentences have been processed")
+
+    def get_dataset(self, include_examples: bool = True, example_selector=None) -> "Dataset":
+        """
+            Returns the rows with a template id column and the prompt renderer attached.
+            The template id picks SYSTEM_PROMPT (with few-shot examples) or EVAL_SYSTEM_PROMPT.
+            The examples come from example_selector when one is given.
+        """
+        template_id = TEMPLATES.index(SYSTEM_PROMPT if include_examples else EVAL_SYSTEM_PROMPT)
+        dataset = self.rows.add_column("template_id", [template_id] * len(self.rows))
+        dataset.set_transform(PromptRenderer(self.sentences, self.queries, example_selector))
+        return dataset
+
+    def get_joint_dataset(self, include_examples: bool = True, example_selector=None) -> "Dataset":
+        """
+            Returns one row per sentence, holding the spans of all its entity types, with
+            JointPromptRenderer attached. The template id picks JOINT_SYSTEM_PROMPT (with
+            few-shot examples) or JOINT_EVAL_SYSTEM_PROMPT.
+
+            With possible_only, entity types that have no row for a sentence have no spans
+            there, and sentences without any entity are left out, as in get_dataset.
+        """
+        template_id = JOINT_TEMPLATES.index(JOINT_SYSTEM_PROMPT if include_examples else JOINT_EVAL_SYSTEM_PROMPT)
+        sentences: Dict[int, Dict[str, list]] = {}
+        type_queries: Dict[int, int] = {}
+
+        for batch in self.rows.iter(batch_size=self.batch_size):
+            for sentence_id, entity_id, query_id, starts, ends in zip(
+                batch["sentence_id"], batch["entity_id"], batch["query_id"], batch["starts"], batch["ends"]
+            ):
+                type_queries.setdefault(entity_id, query_id)
+                row = sentences.setdefault(sentence_id, {"entity_ids": [], "starts": [], "ends": []})
+                row["entity_ids"].append(entity_id)
+                row["starts"].append(starts)
+                row["ends"].append(ends)
+
+        from datasets import Dataset
+
+        sentence_ids = sorted(sentences)
+        dataset = Dataset.from_dict({
+            "sentence_id": sentence_ids,
+            "template_id": [template_id] * len(sentence_ids),
+            "entity_ids": [sentences[i]["entity_ids"] for i in sentence_ids],
+            "starts": [sentences[i]["starts"] for i in sentence_ids],
+            "ends": [sentences[i]["ends"] for i in sentence_ids],
+        })
+        dataset.set_transform(JointPromptRenderer(self.sentences, self.queries, type_queries, example_selector))
+        print(f"Grouped {len(self.rows)} entries into {len(dataset)} joint rows.")
+        return dataset
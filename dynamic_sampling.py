@@ -0,0 +1,332 @@
+import random
+import hashlib
+
+import torch
+import torch.nn.functional as F
+
+from functools import wraps
+from typing import Dict, List, Optional, Tuple
+from accelerate.utils import gather_object
+from torch.utils.data import Sampler
+from trl import GRPOTrainer
+from trl.trainer.grpo_trainer import RepeatSampler
+from profiling import TIMER
+
+
+def prompt_key(prompt) -> bytes:
+    """Key of a conversational prompt, used to track its solve rate"""
+    text = "".join(message["content"] for message in prompt)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class SolveRateTracker:
+    """
+        Per-prompt solve rates, turned into sampling weights.
+
+        The solve rate of a prompt is an exponential moving average (factor `decay`) of
+        the fraction of its group's completions that were solved. Prompts the model always
+        or never solves have solve rates near 1 or 0 and teach nothing, so their weight
+        falls towards `min_weight`: weight = min_weight + (1 - min_weight) * 4p(1 - p).
+        Prompts that have not been seen yet keep weight 1.
+    """
+    def __init__(self, min_weight: float = 0.1, decay: float = 0.5):
+        self.min_weight = min_weight
+        self.decay = decay
+        self.rates: Dict[bytes, float] = {}
+
+    def update(self, key: bytes, solved_fraction: float):
+        old = self.rates.get(key)
+        self.rates[key] = solved_fraction if old is None else self.decay * old + (1 - self.decay) * solved_fraction
+
+    def weight(self, key: bytes) -> float:
+        rate = self.rates.get(key)
+        if rate is None:
+            return 1.0
+        return self.min_weight + (1 - self.min_weight) * 4 * rate * (1 - rate)
+
+    def stats(self, ) -> Dict[str, float]:
+        if not self.rates:
+            return {}
+        rates = list(self.rates.values())
+        return {
+            "solve_rate/tracked_prompts": len(rates),
+            "solve_rate/mean": sum(rates) / len(rates),
+            "solve_rate/always_solved_fraction": sum(rate == 1.0 for rate in rates) / len(rates),
+            "solve_rate/never_solved_fraction": sum(rate == 0.0 for rate in rates) / len(rates),
+            "solve_rate/mean_weight": sum(self.weight(key) for key in self.rates) / len(rates),
+        }
+
+
+class SolveRateSampler(RepeatSampler):
+    """
+        RepeatSampler that thins out prompts by their SolveRateTracker weight.
+
+        Every slot of the shuffled order is kept with probability equal to the weight of
+        its prompt, and otherwise redrawn uniformly, up to `max_tries` times, so the
+        sampler's length does not change. Keys are computed lazily, the first time an
+        index is drawn, and weights are read when a batch is drawn, so they follow the
+        tracker as training goes. All processes must share the tracker state and the
+        seed, like RepeatSampler requires.
+    """
+    def __init__(self, data_source, tracker: SolveRateTracker, *args, max_tries: int = 8, **kwargs):
+        super().__init__(data_source, *args, **kwargs)
+        self.tracker = tracker
+        self.max_tries = max_tries
+        self.random = random.Random(self.seed)
+        self.keys: Dict[int, bytes] = {}
+
+    def key(self, index: int) -> bytes:
+        if index not in self.keys:
+            self.keys[index] = prompt_key(self.data_source[index]["prompt"])
+        return self.keys[index]
+
+    def draw(self, index: int, rng: random.Random) -> int:
+        """Index to use in place of `index`: itself, or a replacement if it is rejected"""
+        if not self.tracker.rates:
+            return index
+        for _ in range(self.max_tries):
+            if rng.random() < self.tracker.weight(self.key(index)):
+                return index
+            index = rng.randrange(self.num_samples)
+        return index
+
+    def __iter__(self):
+        if self.shuffle:
+            indexes = torch.randperm(self.num_samples, generator=self.generator).tolist()
+        else:
+            indexes = list(range(self.num_samples))
+
+        indexes = [indexes[i : i + self.batch_size] for i in range(0, len(indexes), self.batch_size)]
+        indexes = [chunk for chunk in indexes if len(chunk) == self.batch_size]
+
+        for chunk in indexes:
+            chunk = [self.draw(index, self.random) for index in chunk]
+            for _ in range(self.repeat_count):
+                for index in chunk:
+                    for _ in range(self.mini_repeat_count):
+                        yield index
+
+
+# groups whose total rewards vary less than this count as zero-advantage
+REWARD_STD_TOLERANCE = 1e-6
+
+# tensors GRPOTrainer left-pads; every other 2-D tensor of a scored batch is right-padded
+LEFT_PADDED = ("prompt_ids", "prompt_mask")
+
+
+class DynamicSamplingGRPOTrainer(GRPOTrainer):
+    """
+        GRPOTrainer that keeps zero-advantage prompt groups out of the gradient step.
+
+        A group whose completions all get the same reward (group reward std at most
+        REWARD_STD_TOLERANCE) has zero advantage and only costs compute. After a batch is
+        scored, such groups are dropped and a fresh batch of prompts is generated and
+        scored, for up to `max_resample_rounds` rounds; each dropped group takes the fresh
+        group in its slot when that one is informative. Groups still missing after that
+        keep their dropped completions, so the batch keeps its size.
+
+        Like GRPOTrainer, groups are formed over the batch gathered from all processes, so
+        a group may span processes. Every decision is made on gathered rewards, and fresh
+        prompts are drawn identically on every process, so each process swaps in its own
+        slice of the same groups.
+
+        A completion counts as solved when the reward function named `solve_reward_func`
+        gives it at least `solve_threshold`. Per-prompt solve rates are tracked in a
+        SolveRateTracker, which down-weights always and never solved prompts both in the
+        train sampler and when fresh prompts are drawn.
+
+        trl's own metrics and completion tables keep only the first scoring pass of a
+        step. Skip rates, effective batch size and solve rate statistics are returned by
+        `pop_metrics`, for MetricsCallback.
+    """
+    def __init__(
+        self,
+        *args,
+        solve_reward_func: str = "correctness_reward_func",
+        solve_threshold: float = 2.0,
+        max_resample_rounds: int = 2,
+        min_weight: float = 0.1,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        if solve_reward_func not in self.reward_func_names:
+            raise ValueError(f"{solve_reward_func} is not one of the reward functions {self.reward_func_names}")
+        global_batch = self.args.per_device_train_batch_size * self.accelerator.num_processes
+        if global_batch % self.num_generations:
+            raise ValueError(
+                f"Dynamic sampling needs whole prompt groups in every scored batch, but the global batch of "
+                f"{global_batch} is not a multiple of num_generations={self.num_generations}"
+            )
+
+        self.solve_threshold = solve_threshold
+        self.max_resample_rounds = max_resample_rounds
+        self.tracker = SolveRateTracker(min_weight)
+        self.solve_sampler: Optional[SolveRateSampler] = None
+        # same seed on every process: fresh groups span processes, so all must draw the same prompts
+        self._fresh_random = random.Random(self.args.seed)
+
+        # record every function's rewards of each scoring pass, in local completion order
+        self.solve_reward_func = solve_reward_func
+        self._recorded: Dict[str, List[Optional[float]]] = {}
+        self.reward_funcs = [self._recording(func) for func in self.reward_funcs]
+
+        self._counts = {"steps": 0, "groups": 0, "zero_advantage": 0, "effective": 0, "resampled": 0, "rounds": 0}
+
+    def _recording(self, func):
+        @wraps(func)
+        def reward(*args, **kwargs):
+            rewards = func(*args, **kwargs)
+            self._recorded[func.__name__] = list(rewards)
+            return rewards
+        return reward
+
+    def _get_train_sampler(self) -> Sampler:
+        effective_batch_size = (
+            self.args.per_device_train_batch_size
+            * self.accelerator.num_processes
+            * self.args.gradient_accumulation_steps
+        )
+        self.solve_sampler = SolveRateSampler(
+            self.train_dataset,
+            self.tracker,
+            mini_repeat_count=self.num_generations,
+            batch_size=effective_batch_size // self.num_generations,
+            repeat_count=self.num_iterations * self.args.gradient_accumulation_steps,
+            shuffle=self.shuffle_dataset,
+            seed=self.args.seed,
+        )
+        return self.solve_sampler
+
+    def _group_reward_std(self, ) -> torch.Tensor:
+        """Std of the weighted total reward of each group of the gathered batch, computed like GRPOTrainer does"""
+        columns = [
+            [float("nan") if reward is None else reward for reward in self._recorded[name]]
+            for name in self.reward_func_names
+        ]
+        rewards_per_func = torch.tensor(columns, dtype=torch.float32).T
+        rewards = (rewards_per_func * self.reward_weights.unsqueeze(0)).nansum(dim=1)
+        rewards = torch.tensor(gather_object(rewards.tolist()), dtype=torch.float32)
+        return rewards.view(-1, self.num_generations).std(dim=1)
+
+    def _snapshot_logs(self, ) -> tuple:
+        lengths = {key: len(values) for key, values in self._metrics["train"].items()}
+        texts = {key: list(self._textual_logs[key]) for key in ("prompt", "completion")}
+        rewards = {name: list(values) for name, values in self._textual_logs["rewards"].items()}
+        return lengths, texts, rewards
+
+    def _restore_logs(self, snapshot: tuple):
+        """Drops what resample rounds logged, so trl's metrics and tables describe one pass per step"""
+        lengths, texts, rewards = snapshot
+        metrics = self._metrics["train"]
+        for key in list(metrics):
+            if key in lengths:
+                del metrics[key][lengths[key]:]
+            else:
+                del metrics[key]
+        for key, values in texts.items():
+            self._textual_logs[key].clear()
+            self._textual_logs[key].extend(values)
+        for name, values in rewards.items():
+            self._textual_logs["rewards"][name].clear()
+            self._textual_logs["rewards"][name].extend(values)
+
+    def _score(self, inputs) -> Tuple[dict, List[bool]]:
+        """Generates and scores a batch; returns it with a has-advantage flag per group of the gathered batch"""
+        with TIMER.stage("train/generate_and_score"):
+            batch = super()._generate_and_score_completions(inputs)
+
+        solved = [
+            reward is not None and reward >= self.solve_threshold for reward in self._recorded[self.solve_reward_func]
+        ]
+        # every process applies every update, so the samplers stay in step
+        rows = gather_object([(prompt_key(example["prompt"]), done) for example, done in zip(inputs, solved)])
+        for start in range(0, len(rows), self.num_generations):
+            group = rows[start : start + self.num_generations]
+            self.tracker.update(group[0][0], sum(done for _, done in group) / self.num_generations)
+
+        # advantages of a constant group are only near zero after normalisation, so test the rewards
+        return batch, (self._group_reward_std() > REWARD_STD_TOLERANCE).tolist()
+
+    def _fresh_inputs(self, num_groups: int, local_size: int) -> list:
+        """This process's slice of a fresh batch of `num_groups` groups, laid out like the scored batch"""
+        indices = [
+            self.solve_sampler.draw(self._fresh_random.randrange(len(self.train_dataset)), self._fresh_random)
+            for _ in range(num_groups)
+        ]
+        start = self.accelerator.process_index * local_size
+        return [self.train_dataset[indices[row // self.num_generations]] for row in range(start, start + local_size)]
+
+    def _local_pieces(self, sources: List[dict], local_size: int) -> List[Tuple[dict, int, int]]:
+        """(batch, start, end) row ranges of this process's slice, each group's rows taken from its source batch"""
+        offset = self.accelerator.process_index * local_size
+        pieces = []
+        for group, source in enumerate(sources):
+            start = max(group * self.num_generations, offset) - offset
+            end = min((group + 1) * self.num_generations, offset + local_size) - offset
+            if start < end:
+                pieces.append((source, start, end))
+        return pieces
+
+    def _concat_pieces(self, pieces: List[Tuple[dict, int, int]]) -> dict:
+        """Builds a batch out of (scored batch, start, end) row ranges, padding to the widest piece"""
+        merged = {}
+        for key, first in pieces[0][0].items():
+            if first is None:
+                merged[key] = None
+                continue
+            parts = [batch[key][start:end] for batch, start, end in pieces]
+            if first.dim() == 2:
+                width = max(part.size(1) for part in parts)
+                value = self.processing_class.pad_token_id if key.endswith("_ids") else 0
+                parts = [
+                    F.pad(part, (width - part.size(1), 0) if key in LEFT_PADDED else (0, width - part.size(1)), value=value)
+                    for part in parts
+                ]
+            merged[key] = torch.cat(parts)
+        return merged
+
+    def _generate_and_score_completions(self, inputs):
+        if self.control.should_evaluate or self.solve_sampler is None:
+            return super()._generate_and_score_completions(inputs)
+
+        batch, informative = self._score(inputs)
+        num_groups = len(informative)
+        # the batch each group of the gathered batch is taken from; None while it has no advantage
+        sources: List[Optional[dict]] = [batch if has_advantage else None for has_advantage in informative]
+        self._counts["steps"] += 1
+        self._counts["groups"] += num_groups
+        self._counts["zero_advantage"] += num_groups - sum(informative)
+
+        logs = self._snapshot_logs()
+        for _ in range(self.max_resample_rounds):
+            # decisions come from gathered rewards, so every process runs the same rounds
+            missing = [group for group, source in enumerate(sources) if source is None]
+            if not missing:
+                break
+            fresh, fresh_informative = self._score(self._fresh_inputs(num_groups, len(inputs)))
+            for group in missing:
+                if fresh_informative[group]:
+                    sources[group] = fresh
+            self._counts["resampled"] += len(missing)
+            self._counts["rounds"] += 1
+        self._restore_logs(logs)
+
+        self._counts["effective"] += sum(source is not None for source in sources)
+        sources = [batch if source is None else source for source in sources]
+        if all(source is batch for source in sources):
+            return batch
+        return self._concat_pieces(self._local_pieces(sources, len(inputs)))
+
+    def pop_metrics(self, ) -> Dict[str, float]:
+        """Dynamic sampling and solve rate metrics since the last call, for MetricsCallback"""
+        counts = self._counts
+        self._counts = {key: 0 for key in counts}
+        metrics = self.tracker.stats()
+        if counts["steps"]:
+            metrics.update({
+                "dynamic_sampling/zero_advantage_rate": counts["zero_advantage"] / counts["groups"],
+                "dynamic_sampling/effective_batch_fraction": counts["effective"] / counts["groups"],
+                "dynamic_sampling/resampled_groups": counts["resampled"] / counts["steps"],
+                "dynamic_sampling/resample_rounds": counts["rounds"] / counts["steps"],
+            })
+        return metrics
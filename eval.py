@@ -1,134 +1,261 @@
 import os
-import re
 import pandas as pd
-from typing import List, Tuple
-from vllm import LLM, SamplingParams
-from data_loading import load_conll_dataset
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from data_loading import LABEL_TO_STR, load_conll_dataset
+from metrics import MetricsAccumulator, extract_entities_from_xml, extract_typed_entities_from_xml
+from generation_cache import GenerationCache
+from prompt_store import PromptTokenStore
+from scheduling import BucketScheduler, order_by_shared_prefix
+from profiling import TIMER, cprofile, timed
 
-def extract_entities_from_xml(text: str) -> List[str]:
+if TYPE_CHECKING:
+    # vllm initialises CUDA on import, so it is only imported once an engine is needed
+    from vllm import LLM, SamplingParams
+
+def load_llm(model_path: str, max_model_len: int = 2048) -> "LLM":
+    """The vLLM engine used for evaluation, with prefix caching on"""
+    from vllm import LLM
+
+    return LLM(
+        model=model_path,
+        tensor_parallel_size=1,
+        device="auto",
+        max_model_len=max_model_len,
+        seed=42,
+        gpu_memory_utilization=0.6,
+        enforce_eager=True,
+        enable_prefix_caching=True,
+    )
+
+def prefill_stats(outputs) -> Dict[str, float]:
+    """Count prompt tokens and how many of them the engine served from its prefix cache"""
+    prompt_tokens = sum(len(output.prompt_token_ids) for output in outputs)
+    cached_tokens = sum(output.num_cached_tokens or 0 for output in outputs)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'cached_fraction': cached_tokens / prompt_tokens if prompt_tokens > 0 else 0,
+    }
+
+@timed("eval/generate")
+def generate(
+    model: "LLM",
+    prompts: List[str],
+    sampling_params: "SamplingParams",
+    prefix_schedule: bool = True,
+    prompt_store: Optional[PromptTokenStore] = None,
+    scheduler: Optional[BucketScheduler] = None,
+    keys: Optional[List[str]] = None,
+):
+    """Run the engine over prompts, returning one RequestOutput per prompt in the given order
+
+    Prompts found in prompt_store are sent to the engine as token ids, so vLLM skips tokenising them.
+    With a scheduler, prompts are submitted in length buckets with per-request completion
+    budgets estimated per key (see BucketScheduler) instead of in a single call.
     """
-    Extract entities from <entity> tags in the given text.
-    Args:
-        text: String containing XML with <entity> tags
-    Returns:
-        List of entities found (empty list if none found)
+    engine_prompts = list(prompts)
+    # rough length for prompts the store does not have, only used to pick a bucket
+    prompt_lengths = [len(prompt) // 4 for prompt in prompts]
+    if prompt_store is not None:
+        for i, prompt in enumerate(prompts):
+            token_ids = prompt_store.lookup(prompt)
+            if token_ids is not None:
+                engine_prompts[i] = {'prompt_token_ids': token_ids}
+                prompt_lengths[i] = len(token_ids)
+
+    if scheduler is not None:
+        outputs = scheduler.run(
+            model, prompts, engine_prompts, prompt_lengths, sampling_params, keys or [''] * len(prompts)
+        )
+    elif prefix_schedule:
+        order = order_by_shared_prefix(prompts)
+        scheduled = model.generate([engine_prompts[i] for i in order], sampling_params)
+        outputs = [None] * len(prompts)
+        for i, output in zip(order, scheduled):
+            outputs[i] = output
+    else:
+        outputs = model.generate(engine_prompts, sampling_params)
+
+    TIMER.count("eval/generated_prompts", len(prompts))
+    stats = prefill_stats(outputs)
+    print(
+        f"Prefix cache served {stats['cached_tokens']} of {stats['prompt_tokens']} "
+        f"prompt tokens ({stats['cached_fraction']:.1%})"
+    )
+    return outputs
+
+def make_sampling_params(num_samples: int = 1, temperature: float = 0.0, joint: bool = False) -> "SamplingParams":
+    """Evaluation sampling parameters; greedy decoding (temperature=0.0) only ever needs one sample
+
+    Generation stops at the end of the answer, which is </entities> for joint prompts.
     """
-    entity_matches = re.findall(r'<entity>(.*?)</entity>', text, re.DOTALL)
-    
-    if not entity_matches:
-        return []
-    
-    entities_str = entity_matches[-1].strip()
-    
-    if not entities_str:
-        return []
-        
-    entities = [e.strip() for e in entities_str.split(',') if e.strip()]
-    return entities
+    from vllm import SamplingParams
+
+    return SamplingParams(
+        temperature=temperature,
+        top_p=0.8,
+        max_tokens=2048,
+        stop=["</entities>" if joint else "</entity>"],
+        include_stop_str_in_output=True,
+        n=1 if temperature == 0.0 else num_samples,
+        seed=42
+    )
+
+def make_generate_fn(
+    model: "LLM", num_samples: int = 1, temperature: float = 0.0, joint: bool = False, **generate_kwargs
+) -> Callable[[List[str]], List[List[str]]]:
+    """Wrap the engine as a function from prompts to num_samples completion texts per prompt
+
+    This is the generator interface ShardedEvalRunner expects. generate_kwargs are passed on to generate().
+    """
+    sampling_params = make_sampling_params(num_samples, temperature, joint)
+
+    def generate_texts(prompts: List[str]) -> List[List[str]]:
+        outputs = generate(model, prompts, sampling_params, **generate_kwargs)
+        texts = [[out.text for out in output.outputs] for output in outputs]
+        if sampling_params.n != num_samples:
+            texts = [row * num_samples for row in texts]
+        return texts
 
-def predict_entities(model: LLM, dataset: pd.DataFrame) -> List[List[str]]:
+    return generate_texts
+
+@timed("eval/predict_entities")
+def predict_entities(
+    model: "LLM",
+    dataset: pd.DataFrame,
+    prefix_schedule: bool = True,
+    num_samples: int = 1,
+    temperature: float = 0.0,
+    cache: Optional[GenerationCache] = None,
+    prompt_store: Optional[PromptTokenStore] = None,
+    scheduler: Optional[BucketScheduler] = None,
+    joint: bool = False,
+) -> Tuple[list, list, List[str]]:
     """Predict entities for a dataset using vLLM for generation
     
+    All samples of a prompt are requested in a single engine call (n=num_samples), so
+    each prompt is prefilled once. With temperature=0.0 decoding is greedy and every
+    sample would be identical, so only one is generated and it is reused.
+
     Args:
         model: Initialized vLLM model
         dataset: Dataset containing columns titled 'prompt' and 'answer'
+        prefix_schedule: Submit prompts grouped by shared prefix (see order_by_shared_prefix)
+            instead of in dataset order. Outputs are returned in dataset order either way.
+        num_samples: Number of completions per prompt
+        temperature: Sampling temperature
+        cache: If given, completions are read from it and only the misses are generated
+        prompt_store: If given, prompts are sent to the engine as their cached token ids
+        scheduler: If given, prompts are generated in length buckets with estimated
+            per-request max_tokens, keyed by entity type
+        joint: The dataset holds joint prompts (load_conll_dataset(joint=True)), so every
+            prediction and ground truth maps entity types to entity lists
         
     Returns:
-        Tuple of (predictions, ground_truths) where:
-        - predictions: List of predicted entity lists
+        Tuple of (predictions, ground_truths, entity_types) where:
+        - predictions: For each sample, the list of predicted entity lists of every prompt
         - ground_truths: List of ground truth entity lists
+        - entity_types: The entity type of every prompt, as read from the rendered rows
+        With joint, each entity list is a dictionary from entity type to entity list.
     """
     no_entities_count = 0
-    prompts = [example['prompt'][0]['content'] for example in dataset]
-    
-    sampling_params = SamplingParams(
-        temperature=0.0,
-        top_p=0.8,
-        max_tokens=2048,
-        stop=["</entity>"],
-        include_stop_str_in_output=True,
-        n=1,
-        seed=42
-    )
+    prompts, answers, entity_types = [], [], []
+    for example in dataset:
+        prompts.append(example['prompt'][0]['content'])
+        answers.append(example['answer'])
+        entity_types.append(example.get('entity', ''))
 
-    outputs = model.generate(prompts, sampling_params)
-    predictions = []
-    ground_truths = []
-    
-    for idx, output in enumerate(outputs):
-        gt_text = dataset[idx]['answer']
-        gt_entities = extract_entities_from_xml(gt_text)
-        ground_truths.append(gt_entities)
-        
-        generated_texts = [out.text for out in output.outputs]
+    deterministic = temperature == 0.0
+    sampling_params = make_sampling_params(num_samples, temperature, joint)
+    extract = extract_typed_entities_from_xml if joint else extract_entities_from_xml
 
-        for text in generated_texts:
+    texts = cache.get_many(prompts, sampling_params) if cache is not None else [None] * len(prompts)
+    misses = [idx for idx, cached in enumerate(texts) if cached is None]
+    if cache is not None:
+        print(f"Generation cache hit {len(prompts) - len(misses)} of {len(prompts)} prompts")
+
+    if misses:
+        miss_prompts = [prompts[idx] for idx in misses]
+        outputs = generate(
+            model, miss_prompts, sampling_params, prefix_schedule, prompt_store,
+            scheduler, [entity_types[idx] for idx in misses],
+        )
+        for idx, output in zip(misses, outputs):
+            texts[idx] = [out.text for out in output.outputs]
+        if cache is not None:
+            cache.put_many(miss_prompts, sampling_params, [texts[idx] for idx in misses])
+
+    predictions = [[] for _ in range(sampling_params.n)]
+    ground_truths = [extract(answer) for answer in answers]
+    
+    for generated_texts in texts:
+        for sample, text in zip(predictions, generated_texts):
             try:
-                entities = extract_entities_from_xml(text)
-                predictions.append(entities)
+                entities = extract(text)
+                sample.append(entities)
             except Exception as e:
                 no_entities_count += 1
-                predictions.append([])
+                sample.append({} if joint else [])
                 print(f"Error extracting entities: {e}")
                 continue
-    print(f"Out of {len(prompts)}, {no_entities_count} were unsuccessful")
-    return predictions, ground_truths
+    print(f"Out of {len(prompts) * sampling_params.n}, {no_entities_count} were unsuccessful")
 
-def evaluate_predictions(predictions, ground_truths):
-    """Calculate precision, recall and F1 score"""
-    tp = fp = fn = 0
-    
-    for pred, gt in zip(predictions, ground_truths):
-        pred_set = set(pred)
-        gt_set = set(gt)
-        
-        tp += len(pred_set & gt_set)
-        fp += len(pred_set - gt_set)
-        fn += len(gt_set - pred_set)
-    
-    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
-    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-    
-    return {
-        'precision': precision,
-        'recall': recall,
-        'f1': f1,
-        'true_positives': tp,
-        'false_positives': fp,
-        'false_negatives': fn
-    }
-    
+    if deterministic:
+        # greedy decoding: every requested sample is the one we generated
+        predictions = predictions * num_samples
+    return predictions, ground_truths, entity_types
 
 if __name__ == "__main__":
     model_path = "Qwen/Qwen2.5-1.5B-Instruct"  
-    llm = LLM(
-        model=model_path, 
-        tensor_parallel_size=1,
-        device="auto",
-        max_model_len=2048,
-        seed=42,
-        gpu_memory_utilization=0.6,
-        enforce_eager=True,
-    )
+    llm = load_llm(model_path)
 
-    test_df = load_conll_dataset("data/conll03/mrc-ner.test", include_examples=True)
-    print(f"There are {len(test_df)} rows in my dataset")
+    # one prompt per sentence for all four entity types instead of one per type
+    joint = False
+    # NER_PROFILE=<path> runs the evaluation under cProfile
+    with cprofile():
+        test_df = load_conll_dataset("data/conll03/mrc-ner.test", include_examples=True, compact=True, joint=joint)
+        prompt_store = PromptTokenStore(test_df, llm.get_tokenizer(), max_prompt_length=2048, chat_template=False)
+        test_df = test_df.select(prompt_store.keep_indices())
+        print(f"There are {len(test_df)} rows in my dataset")
 
-    f1_scores, num_generations = 0.0, 16
-    
-    for itr in range(num_generations):
-        predictions, ground_truths = predict_entities(llm, test_df)
-        metrics = evaluate_predictions(predictions, ground_truths)
-        print(f"F1 result at iteration {itr} is {metrics['f1']}")
-        f1_scores += metrics['f1']
+        num_generations = 16
+        cache = GenerationCache(model_path)
+        scheduler = BucketScheduler(max_model_len=2048)
+
+        # the compact dataset renders 'entity' per row; it is not a stored column
+        predictions, ground_truths, entity_types = predict_entities(
+            llm, test_df, num_samples=num_generations, cache=cache, prompt_store=prompt_store, scheduler=scheduler,
+            joint=joint,
+        )
+        with TIMER.stage("eval/metrics"):
+            accumulator = MetricsAccumulator(num_generations, tuple(LABEL_TO_STR.values()))
+            accumulator.update_samples(predictions, ground_truths, entity_types)
+            metrics = accumulator.metrics()
+    for itr, f1 in enumerate(metrics['f1']):
+        print(f"F1 result at iteration {itr} is {f1}")
         
-    avg_f1_scores = f1_scores / num_generations
-    print(f"Evaluation Metrics (F1): {avg_f1_scores}")
+    avg_f1_scores = metrics['f1_mean']
+    print(
+        f"Evaluation Metrics (F1): {avg_f1_scores} "
+        f"(95% CI {metrics['f1_ci_low']:.4f} - {metrics['f1_ci_high']:.4f})"
+    )
+    for entity_type, entity_metrics in metrics['per_entity'].items():
+        print(f"{entity_type} F1: {entity_metrics['f1_mean']:.4f} (std {entity_metrics['f1_std']:.4f})")
 
     results_df = pd.DataFrame({
         'f1': [avg_f1_scores],
+        'f1_std': [metrics['f1_std']],
+        'f1_ci_low': [metrics['f1_ci_low']],
+        'f1_ci_high': [metrics['f1_ci_high']],
+        **{
+            f"f1_{entity_type.lower()}": [entity_metrics['f1_mean']]
+            for entity_type, entity_metrics in metrics['per_entity'].items()
+        },
     })
     
-    results_df.to_csv(f"results/{model_path.split('/')[-1]}.csv", index=False)
-    print("Predictions saved to results/conll03_entity_predictions.csv")
\ No newline at end of file
+    results_name = f"results/{model_path.split('/')[-1]}{'-joint' if joint else ''}"
+    results_df.to_csv(f"{results_name}.csv", index=False)
+    print("Predictions saved to results/conll03_entity_predictions.csv")
+
+    print(TIMER.report())
+    TIMER.export(f"{results_name}-timing.json", model=model_path, joint=joint, num_generations=num_generations)
\ No newline at end of file
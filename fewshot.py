@@ -0,0 +1,167 @@
+import math
+import re
+import numpy as np
+
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+from data_loading import CACHE_DIR, ENTITY_LABELS, JOINT_ENTITY, LABEL_TO_STR, CompactNER
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def whitespace_tokens(text: str) -> int:
+    """Default token counter: a cheap stand-in for the model tokenizer"""
+    return len(text.split())
+
+
+class BM25Index:
+    """
+        Okapi BM25 over a fixed list of documents, stored as an inverted index of numpy
+        postings arrays, so a query only touches the documents that share a term with it.
+    """
+    def __init__(self, documents: Sequence[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(documents)
+        lengths = np.array([len(doc) for doc in documents], dtype=np.float64)
+        self.length_norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0)) if len(documents) else lengths
+
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for doc_id, doc in enumerate(documents):
+            for term, count in Counter(doc).items():
+                ids, counts = postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                counts.append(count)
+        self.postings = {
+            term: (np.array(ids, dtype=np.int64), np.array(counts, dtype=np.float64))
+            for term, (ids, counts) in postings.items()
+        }
+        self.idf = {
+            term: math.log(1 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            for term, (ids, _) in self.postings.items()
+        }
+
+    def search(self, query: List[str], k: int) -> List[int]:
+        """Ids of the k best scoring documents, best first; documents sharing no term are never returned"""
+        scores = np.zeros(self.num_docs, dtype=np.float64)
+        matched = np.zeros(self.num_docs, dtype=bool)
+        for term in set(query):
+            if term not in self.postings:
+                continue
+            ids, counts = self.postings[term]
+            scores[ids] += self.idf[term] * counts * (self.k1 + 1) / (counts + self.length_norm[ids])
+            matched[ids] = True
+
+        candidates = np.flatnonzero(matched)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind="stable")].tolist()
+
+
+class FewShotSelector:
+    """
+        Picks few-shot examples for a prompt from a pool of labelled sentences (the
+        training split) instead of using the static ENTITY_EXAMPLES block.
+
+        The pool sentences are indexed with BM25. For a context, the best matching pool
+        sentences (other than the context itself) are rendered as examples for the
+        requested entity type, or for every type with JOINT_ENTITY, and added in rank
+        order while they fit in `token_budget` tokens, up to `k` of them. Tokens are
+        counted with `count_tokens`, which defaults to a whitespace split.
+
+        The pool sentences carry no reasoning, so each example gets a one-line think
+        section naming its entities. Selections are cached per (context, entity type).
+    """
+    def __init__(
+        self,
+        contexts: List[str],
+        typed_spans: List[Dict[str, List[Tuple[int, int]]]],
+        k: int = 3,
+        token_budget: int = 256,
+        count_tokens: Callable[[str], int] = whitespace_tokens,
+        candidates: int = 16,
+        cache_size: int = 65536,
+    ):
+        self.contexts = contexts
+        self.typed_spans = typed_spans
+        self.k = k
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.candidates = candidates
+        self.cache_size = cache_size
+        self.index = BM25Index([tokenize(context) for context in contexts])
+        self.cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._example_tokens: Dict[Tuple[int, str], int] = {}
+
+    @classmethod
+    def from_conll(cls, file_path: str, cache_dir: str = CACHE_DIR, **kwargs) -> "FewShotSelector":
+        """Builds the pool from a CoNLL MRC file, through the CompactNER cache"""
+        data = CompactNER(file_path, True, cache_dir=cache_dir)
+        typed_spans: List[Dict[str, List[Tuple[int, int]]]] = [{} for _ in range(len(data.sentences))]
+        for batch in data.rows.iter(batch_size=data.batch_size):
+            for sentence_id, entity_id, starts, ends in zip(
+                batch["sentence_id"], batch["entity_id"], batch["starts"], batch["ends"]
+            ):
+                typed_spans[sentence_id][LABEL_TO_STR[ENTITY_LABELS[entity_id]]] = list(zip(starts, ends))
+        return cls(data.sentences.to_pylist(), typed_spans, **kwargs)
+
+    def render(self, doc_id: int, entity: str) -> str:
+        """One pool sentence as an example for `entity`, or for every type with JOINT_ENTITY"""
+        words = self.contexts[doc_id].split(" ")
+        spans = self.typed_spans[doc_id]
+
+        def entities(entity_type: str) -> List[str]:
+            return [" ".join(words[start : end + 1]) for start, end in spans.get(entity_type, [])]
+
+        if entity == JOINT_ENTITY:
+            found = [f"{entity_type}: {', '.join(entities(entity_type)) or 'none'}" for entity_type in LABEL_TO_STR.values()]
+            sections = " ".join(
+                f"<{entity_type.lower()}>{', '.join(entities(entity_type))}</{entity_type.lower()}>"
+                for entity_type in LABEL_TO_STR.values()
+            )
+            think = "; ".join(found)
+            answer = f"<entities> {sections} </entities>"
+        else:
+            found = entities(entity)
+            think = (
+                f"The {entity} entities in the sentence are " + ", ".join(f'"{e}"' for e in found) + "."
+                if found else f"No {entity} entities are mentioned in the sentence."
+            )
+            answer = f"<entity>{', '.join(found)}</entity>"
+        return f"User: {self.contexts[doc_id]}\nAssistant:\n<think> {think} </think> {answer}\n"
+
+    def _tokens(self, doc_id: int, entity: str, text: str) -> int:
+        key = (doc_id, entity)
+        if key not in self._example_tokens:
+            self._example_tokens[key] = self.count_tokens(text)
+        return self._example_tokens[key]
+
+    def select(self, context: str, entity: str) -> str:
+        """The examples block for a prompt, formatted like the entries of ENTITY_EXAMPLES"""
+        key = (context, entity)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        examples, used = [], 0
+        for doc_id in self.index.search(tokenize(context), self.candidates):
+            if self.contexts[doc_id] == context:
+                continue
+            text = self.render(doc_id, entity)
+            tokens = self._tokens(doc_id, entity, text)
+            if used + tokens > self.token_budget:
+                continue
+            examples.append(f"Example {len(examples) + 1}:\n{text}")
+            used += tokens
+            if len(examples) == self.k:
+                break
+
+        block = "\n" + "\n".join(examples)
+        self.cache[key] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
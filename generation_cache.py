@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+from typing import Dict, List, Optional
+
+CACHE_PATH = "cache/generations.sqlite"
+
+# SamplingParams fields that change what the engine returns for a prompt
+SAMPLING_FIELDS = (
+    "n", "temperature", "top_p", "top_k", "min_p", "seed", "max_tokens",
+    "stop", "include_stop_str_in_output", "repetition_penalty",
+)
+
+
+def checkpoint_hash(model_path: str) -> str:
+    """
+        Identifies a model for caching. Hub ids are used as they are; for a local
+        checkpoint directory the config and the names, sizes and modification times of
+        the weight files are hashed, so retraining into the same directory invalidates it.
+    """
+    if not os.path.isdir(model_path):
+        return model_path
+
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(model_path)):
+        path = os.path.join(model_path, name)
+        if name == "config.json":
+            with open(path, "rb") as f:
+                h.update(f.read())
+        elif name.endswith((".safetensors", ".bin", ".pt")):
+            stat = os.stat(path)
+            h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return f"{os.path.basename(os.path.normpath(model_path))}@{h.hexdigest()[:16]}"
+
+
+def sampling_key(sampling_params) -> str:
+    """Canonical JSON of the SamplingParams fields in SAMPLING_FIELDS"""
+    fields = {name: getattr(sampling_params, name, None) for name in SAMPLING_FIELDS}
+    return json.dumps(fields, sort_keys=True, default=str)
+
+
+class GenerationCache:
+    """
+        Content-addressed on-disk cache of completions, stored in a single sqlite file.
+
+        An entry is keyed by the checkpoint, a hash of the prompt and the sampling
+        parameters, and holds the completion texts for that prompt. Once the stored
+        completions exceed `max_bytes`, the least recently read entries are evicted.
+    """
+    def __init__(self, model_path: str, path: str = CACHE_PATH, max_bytes: int = 2 << 30):
+        self.model = checkpoint_hash(model_path)
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS generations (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                completions TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS generations_model ON generations (model);
+            CREATE INDEX IF NOT EXISTS generations_last_access ON generations (last_access);
+        """)
+
+    def _key(self, prompt: str, params_key: str) -> str:
+        h = hashlib.sha256()
+        for part in (self.model, prompt, params_key):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get_many(self, prompts: List[str], sampling_params) -> List[Optional[List[str]]]:
+        """Returns the cached completion texts of every prompt, or None for misses"""
+        params_key = sampling_key(sampling_params)
+        keys = [self._key(prompt, params_key) for prompt in prompts]
+        found = {}
+
+        # stay well below sqlite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, completions FROM generations WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            found.update((key, json.loads(completions)) for key, completions in rows)
+
+        if found:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE generations SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        return [found.get(key) for key in keys]
+
+    def put_many(self, prompts: List[str], sampling_params, completions: List[List[str]]):
+        """Stores the completion texts of every prompt, then evicts down to max_bytes"""
+        params_key = sampling_key(sampling_params)
+        now = time.time()
+        rows = []
+        for prompt, texts in zip(prompts, completions):
+            payload = json.dumps(texts)
+            rows.append((self._key(prompt, params_key), self.model, payload, len(payload.encode("utf-8")), now))
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO generations (key, model, completions, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        self.evict()
+
+    def evict(self, ):
+        """Deletes the least recently read entries until the cache fits in max_bytes"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess, stale = total - self.max_bytes, []
+        for key, size in self.conn.execute("SELECT key, size FROM generations ORDER BY last_access"):
+            stale.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.conn:
+            self.conn.executemany("DELETE FROM generations WHERE key = ?", stale)
+
+    def entries(self, ) -> List[Dict[str, object]]:
+        """Number of entries and bytes stored per checkpoint"""
+        rows = self.conn.execute(
+            "SELECT model, COUNT(*), SUM(size), MAX(last_access) FROM generations GROUP BY model ORDER BY model"
+        )
+        return [
+            {"model": model, "entries": count, "bytes": size, "last_access": last_access}
+            for model, count, size, last_access in rows
+        ]
+
+    def prune(self, model: Optional[str] = None) -> int:
+        """Deletes every entry of `model` (this cache's checkpoint by default), returning how many"""
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM generations WHERE model = ?", (model or self.model,))
+        return cursor.rowcount
+
+    def close(self, ):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or prune the generation cache")
+    parser.add_argument("command", choices=["list", "prune"])
+    parser.add_argument("--model", help="checkpoint key as shown by `list`, or a model path")
+    parser.add_argument("--path", default=CACHE_PATH)
+    args = parser.parse_args()
+
+    cache = GenerationCache(args.model or "", path=args.path)
+    if args.command == "list":
+        for entry in cache.entries():
+            print(f"{entry['model']}\t{entry['entries']} entries\t{entry['bytes'] / 2**20:.1f} MiB")
+    else:
+        if not args.model:
+            parser.error("prune needs --model")
+        # accept either the key printed by `list` or the path it was computed from
+        known = {entry["model"] for entry in cache.entries()}
+        print(f"Pruned {cache.prune(args.model if args.model in known else None)} entries")
+    cache.close()
@@ -0,0 +1,225 @@
+import re
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+from profiling import timed
+
+def extract_entities_from_xml(text: str) -> List[str]:
+    """
+    Extract entities from <entity> tags in the given text.
+    Args:
+        text: String containing XML with <entity> tags
+    Returns:
+        List of entities found (empty list if none found)
+    """
+    entity_matches = re.findall(r'<entity>(.*?)</entity>', text, re.DOTALL)
+    
+    if not entity_matches:
+        return []
+    
+    entities_str = entity_matches[-1].strip()
+    
+    if not entities_str:
+        return []
+        
+    entities = [e.strip() for e in entities_str.split(',') if e.strip()]
+    return entities
+
+def extract_typed_entities_from_xml(text: str) -> Dict[str, List[str]]:
+    """
+    Extract the entities of every type from the last <entities> block of a joint answer.
+    Args:
+        text: String containing an <entities> block with one tag per entity type,
+            e.g. <entities> <person>...</person> <location>...</location> </entities>
+    Returns:
+        Dictionary from entity type ("Person") to the entities found (empty if none found)
+    """
+    blocks = re.findall(r'<entities>(.*?)</entities>', text, re.DOTALL)
+    if not blocks:
+        return {}
+
+    typed = {}
+    for tag, content in re.findall(r'<(\w+)>(.*?)</\1>', blocks[-1], re.DOTALL):
+        typed.setdefault(tag.capitalize(), []).extend(e.strip() for e in content.split(',') if e.strip())
+    return typed
+
+def expand_typed(predictions, ground_truths) -> Tuple[list, list, List[str]]:
+    """Turns joint rows into one row per entity type of the ground truth
+
+    Args:
+        predictions: For each row, the typed predictions (entity type -> entities) of each sample
+        ground_truths: For each row, the typed ground truth
+    Returns:
+        Tuple of (predictions, ground_truths, entity_types) in the single-type layout
+    """
+    rows, truths, entity_types = [], [], []
+    for row_predictions, gt in zip(predictions, ground_truths):
+        for entity_type, entities in gt.items():
+            rows.append([pred.get(entity_type, []) for pred in row_predictions])
+            truths.append(entities)
+            entity_types.append(entity_type)
+    return rows, truths, entity_types
+
+def precision_recall_f1(tp, fp, fn) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Elementwise precision, recall and F1 of count arrays, 0.0 where undefined"""
+    tp, fp, fn = (np.asarray(x, dtype=np.float64) for x in (tp, fp, fn))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+def summarize_counts(tp, fp, fn, z: float = 1.96) -> Dict[str, object]:
+    """Per-sample precision, recall and F1 of per-sample counts, plus mean F1 and its confidence interval"""
+    precision, recall, f1 = precision_recall_f1(tp, fp, fn)
+
+    f1_mean = float(f1.mean()) if len(f1) else 0.0
+    f1_std = float(f1.std(ddof=1)) if len(f1) > 1 else 0.0
+    half_width = z * f1_std / np.sqrt(len(f1)) if len(f1) else 0.0
+
+    return {
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'f1_mean': f1_mean,
+        'f1_std': f1_std,
+        'f1_ci_low': f1_mean - half_width,
+        'f1_ci_high': f1_mean + half_width,
+    }
+
+@timed("eval/evaluate_predictions")
+def evaluate_predictions(predictions, ground_truths):
+    """Calculate precision, recall and F1 score"""
+    tp = fp = fn = 0
+    
+    for pred, gt in zip(predictions, ground_truths):
+        pred_set = set(pred)
+        gt_set = set(gt)
+        
+        tp += len(pred_set & gt_set)
+        fp += len(pred_set - gt_set)
+        fn += len(gt_set - pred_set)
+    
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    
+    return {
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'true_positives': tp,
+        'false_positives': fp,
+        'false_negatives': fn
+    }
+
+
+class MetricsAccumulator:
+    """
+        Running true positive, false positive and false negative counts, filled as
+        predictions stream out of generation.
+
+        Counts live in one int64 array of shape (entity types, samples, 3), so per-type,
+        per-sample and overall metrics are all sums over it. Entity types are registered
+        on first sight; pass `entity_types` (e.g. the values of LABEL_TO_STR) to fix their
+        order. Accumulators of different shards are combined with `merge`, and
+        `state_dict`/`from_state_dict` turn them into JSON-friendly dicts.
+    """
+    def __init__(self, num_samples: int = 1, entity_types: Sequence[str] = ()):
+        self.num_samples = num_samples
+        self.entity_types: List[str] = []
+        self.type_index: Dict[str, int] = {}
+        self.counts = np.zeros((0, num_samples, 3), dtype=np.int64)
+        self.rows = 0
+        for entity_type in entity_types:
+            self._type_id(entity_type)
+
+    def _type_id(self, entity_type: str) -> int:
+        idx = self.type_index.get(entity_type)
+        if idx is None:
+            idx = self.type_index[entity_type] = len(self.entity_types)
+            self.entity_types.append(entity_type)
+            self.counts = np.concatenate([self.counts, np.zeros((1, self.num_samples, 3), dtype=np.int64)])
+        return idx
+
+    def update(self, predictions, ground_truths, entity_types: Optional[Sequence[str]] = None):
+        """Adds a batch of rows
+
+        Args:
+            predictions: For each row, the predicted entity lists of its num_samples samples
+            ground_truths: For each row, the ground truth entity list
+            entity_types: For each row, its entity type (all rows count as '' if not given)
+
+        Joint rows, whose predictions and ground truths map entity types to entities,
+        are split into one row per type by expand_typed, and entity_types is ignored.
+        """
+        if ground_truths and isinstance(ground_truths[0], dict):
+            predictions, ground_truths, entity_types = expand_typed(predictions, ground_truths)
+
+        batch = np.zeros((len(ground_truths), self.num_samples, 3), dtype=np.int64)
+        type_ids = np.zeros(len(ground_truths), dtype=np.int64)
+
+        for row, (row_predictions, gt) in enumerate(zip(predictions, ground_truths)):
+            if len(row_predictions) != self.num_samples:
+                raise ValueError(f"Expected {self.num_samples} samples per row, got {len(row_predictions)}")
+            type_ids[row] = self._type_id(entity_types[row] if entity_types is not None else "")
+            gt_set = set(gt)
+            # replicated greedy samples are the same list object, count them once
+            counted = {}
+            for sample, pred in enumerate(row_predictions):
+                if id(pred) not in counted:
+                    pred_set = set(pred)
+                    counted[id(pred)] = (len(pred_set & gt_set), len(pred_set - gt_set), len(gt_set - pred_set))
+                batch[row, sample] = counted[id(pred)]
+
+        np.add.at(self.counts, type_ids, batch)
+        self.rows += len(ground_truths)
+
+    def update_samples(self, samples, ground_truths, entity_types: Optional[Sequence[str]] = None):
+        """Adds rows given sample-major, as returned by predict_entities"""
+        self.update(list(zip(*samples)) if samples else [], ground_truths, entity_types)
+
+    def merge(self, other: "MetricsAccumulator") -> "MetricsAccumulator":
+        """Adds the counts of another accumulator, e.g. from another shard, to this one"""
+        if other.num_samples != self.num_samples:
+            raise ValueError(f"Cannot merge {other.num_samples}-sample counts into {self.num_samples}-sample counts")
+        for entity_type, counts in zip(other.entity_types, other.counts):
+            self.counts[self._type_id(entity_type)] += counts
+        self.rows += other.rows
+        return self
+
+    def metrics(self, z: float = 1.96) -> Dict[str, object]:
+        """Overall metrics in the format of summarize_counts, plus a 'per_entity' breakdown"""
+        tp, fp, fn = self.counts.sum(axis=0).T
+        metrics = summarize_counts(tp, fp, fn, z)
+        metrics['rows'] = self.rows
+        metrics['per_entity'] = {
+            entity_type: summarize_counts(*counts.T, z)
+            for entity_type, counts in zip(self.entity_types, self.counts)
+        }
+        return metrics
+
+    def summary(self, ) -> str:
+        """One line with the current mean F1 overall and per entity type, for progress logs"""
+        metrics = self.metrics()
+        per_entity = ", ".join(
+            f"{entity_type or 'all'} {values['f1_mean']:.4f}" for entity_type, values in metrics['per_entity'].items()
+        )
+        return (
+            f"{self.rows} rows, F1 {metrics['f1_mean']:.4f} "
+            f"(95% CI {metrics['f1_ci_low']:.4f} - {metrics['f1_ci_high']:.4f}); {per_entity}"
+        )
+
+    def state_dict(self, ) -> Dict[str, object]:
+        return {
+            'num_samples': self.num_samples,
+            'entity_types': list(self.entity_types),
+            'counts': self.counts.tolist(),
+            'rows': self.rows,
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: Dict[str, object]) -> "MetricsAccumulator":
+        accumulator = cls(state['num_samples'], state['entity_types'])
+        accumulator.counts = np.asarray(state['counts'], dtype=np.int64).reshape(len(state['entity_types']), state['num_samples'], 3)
+        accumulator.rows = state['rows']
+        return accumulator
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import argparse
+
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional
+
+# set to a file path to run train.py / eval.py under cProfile and dump the stats there
+PROFILE_ENV = "NER_PROFILE"
+
+
+class StageStats:
+    __slots__ = ("calls", "total", "max")
+
+    def __init__(self, ):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self, ) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "total_s": self.total,
+            "mean_s": self.total / self.calls if self.calls else 0.0,
+            "max_s": self.max,
+        }
+
+
+class StageTimer:
+    """
+        Wall-clock timers and counters for named pipeline stages ("data/load", "reward/...",
+        "eval/generate", ...).
+
+        A timed call costs two perf_counter reads and a dict lookup, so it can stay on in
+        training. Stages nest, and every stage counts its own inclusive time. Totals are
+        kept twice: for the whole run, exported with `export`, and since the last
+        `pop_metrics` call, which MetricsCallback merges into the trainer's logs as
+        `timing/<stage>_s` and `timing/<stage>_calls`.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, float] = {}
+        self._window: Dict[str, StageStats] = {}
+        self._window_counters: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        for stages in (self.stages, self._window):
+            stats = stages.get(name)
+            if stats is None:
+                stats = stages[name] = StageStats()
+            stats.add(seconds)
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+        self._window_counters[name] = self._window_counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name: Optional[str] = None) -> Callable[[Callable], Callable]:
+        """Decorator timing every call of a function as stage `name` (default: its qualified name)"""
+        def decorate(func: Callable) -> Callable:
+            stage = name or f"{func.__module__}.{func.__qualname__}"
+
+            @wraps(func)
+            def timed_func(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            return timed_func
+        return decorate
+
+    def wrap(self, funcs: List[Callable], prefix: str) -> List[Callable]:
+        """Returns the functions timed as `<prefix><function name>`, names kept for the trainer's logs"""
+        return [self.timed(prefix + func.__name__)(func) for func in funcs]
+
+    def pop_metrics(self, ) -> Dict[str, float]:
+        """Stage times and counters since the last call, for MetricsCallback"""
+        window, counters = self._window, self._window_counters
+        self._window, self._window_counters = {}, {}
+        metrics = {}
+        for name, stats in window.items():
+            metrics[f"timing/{name}_s"] = stats.total
+            metrics[f"timing/{name}_calls"] = stats.calls
+        for name, value in counters.items():
+            metrics[f"counters/{name}"] = value
+        return metrics
+
+    def summary(self, ) -> Dict[str, object]:
+        return {
+            "stages": {name: stats.to_dict() for name, stats in sorted(self.stages.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def report(self, ) -> str:
+        """Table of the run totals, slowest stage first"""
+        lines = [f"{'stage':<56} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].total):
+            row = stats.to_dict()
+            lines.append(
+                f"{name:<56} {row['calls']:>8} {row['total_s']:>10.3f} "
+                f"{row['mean_s'] * 1e3:>10.2f} {row['max_s'] * 1e3:>10.2f}"
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<56} {value:>8g}")
+        return "\n".join(lines)
+
+    def export(self, path: str, **meta):
+        """Writes the run totals as JSON, with `meta` (model, run name, ...) alongside them"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"meta": meta, **self.summary()}, f, indent=2)
+
+    def reset(self, ):
+        self.stages.clear()
+        self.counters.clear()
+        self._window.clear()
+        self._window_counters.clear()
+
+
+# process-wide timer that the pipeline modules report to
+TIMER = StageTimer()
+stage = TIMER.stage
+timed = TIMER.timed
+
+
+def compare_timings(baseline: dict, current: dict, tolerance: float = 0.1, min_seconds: float = 0.01) -> List[str]:
+    """
+        Stages of two exported runs whose mean time per call grew by more than `tolerance`
+        (a fraction). Stages faster than `min_seconds` in total in both runs are noise and
+        are not compared.
+    """
+    regressions = []
+    for name, new in current["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None or max(old["total_s"], new["total_s"]) < min_seconds or not old["mean_s"]:
+            continue
+        change = new["mean_s"] / old["mean_s"] - 1
+        if change > tolerance:
+            regressions.append(f"{name}: {old['mean_s'] * 1e3:.2f}ms -> {new['mean_s'] * 1e3:.2f}ms ({change:+.0%})")
+    return regressions
+
+
+@contextmanager
+def cprofile(path: Optional[str] = None, top: int = 25) -> Iterator[Optional[cProfile.Profile]]:
+    """
+        Runs the block under cProfile when `path` (or $NER_PROFILE) is set, dumping the
+        stats to it for snakeviz / pstats and printing the `top` functions by cumulative
+        time. Without a path it does nothing, which leaves the process free for py-spy,
+        e.g. `py-spy record -o profile.svg -- python train.py`.
+    """
+    path = path or os.environ.get(PROFILE_ENV)
+    if not path:
+        yield None
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(path)
+        print(f"Wrote cProfile stats to {path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two exported stage timing files")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed growth of the mean time per call")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = compare_timings(baseline, current, args.tolerance)
+    for line in regressions:
+        print(f"Slower: {line}")
+    if regressions:
+        raise SystemExit(1)
+    print("No stage regressed beyond the tolerance")
@@ -0,0 +1,143 @@
+import os
+import hashlib
+import pyarrow as pa
+
+from typing import Dict, List, Optional
+from datasets import Dataset
+from datasets.fingerprint import Hasher
+from transformers import BatchEncoding, PreTrainedTokenizerBase
+from data_loading import CACHE_DIR
+from profiling import timed
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def prompt_text(prompt: List[Dict[str, str]], tokenizer: PreTrainedTokenizerBase, chat_template: bool) -> str:
+    """
+        The string that actually gets tokenised for a prompt. With chat_template it is what
+        GRPOTrainer builds for a user-turn prompt; without it, the raw content that eval.py
+        sends to vLLM.
+    """
+    if chat_template:
+        return tokenizer.apply_chat_template(
+            prompt, tools=None, continue_final_message=False, tokenize=False, add_generation_prompt=True
+        )
+    return prompt[0]["content"]
+
+
+class PromptTokenStore:
+    """
+        Prompt token ids for a dataset, tokenised once per tokenizer and kept in a
+        memory-mapped Arrow file under `cache_dir`.
+
+        Row i of the store belongs to row i of the dataset and holds the prompt's key, token
+        ids, length and whether it exceeds `max_prompt_length`. With chat_template=True the
+        ids match GRPOTrainer's own tokenisation (chat template applied, no special tokens
+        added). With chat_template=False they match what vLLM produces for the raw prompt
+        content.
+    """
+    schema = pa.schema([
+        ("key", pa.binary()),
+        ("prompt_ids", pa.list_(pa.int32())),
+        ("prompt_length", pa.int32()),
+        ("too_long", pa.bool_()),
+    ])
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        tokenizer: PreTrainedTokenizerBase,
+        max_prompt_length: int,
+        chat_template: bool = True,
+        cache_dir: str = CACHE_DIR,
+        batch_size: int = 1000,
+    ):
+        self.tokenizer = tokenizer
+        self.max_prompt_length = max_prompt_length
+        self.chat_template = chat_template
+
+        fingerprint = Hasher.hash([dataset._fingerprint, tokenizer, max_prompt_length, chat_template])
+        self.path = os.path.join(cache_dir, f"prompt-tokens-{fingerprint}.arrow")
+
+        if os.path.exists(self.path):
+            print(f"Loading cached prompt tokens from {self.path}")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._write(dataset, batch_size)
+
+        self.table = Dataset.from_file(self.path)
+        self.index = {key: row for row, key in enumerate(self.table["key"])}
+
+        too_long = sum(self.table["too_long"])
+        print(f"{too_long} of {len(self.table)} prompts are longer than {max_prompt_length} tokens")
+
+    @timed("data/tokenize_prompts")
+    def _write(self, dataset: Dataset, batch_size: int):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        # vLLM encodes raw prompts with the tokenizer's special tokens, GRPOTrainer encodes templated ones without
+        add_special_tokens = not self.chat_template
+
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_stream(sink, self.schema) as writer:
+            for start in range(0, len(dataset), batch_size):
+                batch = dataset[start : start + batch_size]
+                texts = [prompt_text(prompt, self.tokenizer, self.chat_template) for prompt in batch["prompt"]]
+                ids = self.tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]
+                lengths = [len(row) for row in ids]
+                writer.write_batch(pa.RecordBatch.from_pydict({
+                    "key": [_text_key(text) for text in texts],
+                    "prompt_ids": ids,
+                    "prompt_length": lengths,
+                    "too_long": [length > self.max_prompt_length for length in lengths],
+                }, schema=self.schema))
+
+        os.replace(tmp_path, self.path)
+
+    def keep_indices(self, ) -> List[int]:
+        """Dataset rows whose prompt fits in max_prompt_length"""
+        return [row for row, too_long in enumerate(self.table["too_long"]) if not too_long]
+
+    def lookup(self, text: str) -> Optional[List[int]]:
+        """Token ids of an already tokenised prompt string, or None if the store does not have it"""
+        row = self.index.get(_text_key(text))
+        return None if row is None else self.table[row]["prompt_ids"]
+
+
+class PretokenizedTokenizer:
+    """
+        Stands in for the tokenizer given to GRPOTrainer. The trainer tokenises every
+        batch of templated prompts with a left-padded, no-special-tokens call. Those
+        calls are answered from a PromptTokenStore, and everything else (decoding,
+        chat templates, saving, special token ids) is passed through to the tokenizer.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, store: PromptTokenStore):
+        object.__setattr__(self, "tokenizer", tokenizer)
+        object.__setattr__(self, "store", store)
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.tokenizer, name, value)
+
+    def __call__(self, text=None, **kwargs):
+        cacheable = (
+            self.store.chat_template
+            and isinstance(text, list)
+            and kwargs.get("add_special_tokens") is False
+            and kwargs.get("padding_side") == "left"
+        )
+        ids = [self.store.lookup(t) for t in text] if cacheable else None
+        if not ids or any(row is None for row in ids):
+            return self.tokenizer(text=text, **kwargs)
+
+        width = max(len(row) for row in ids)
+        pad = self.tokenizer.pad_token_id
+        return BatchEncoding(
+            {
+                "input_ids": [[pad] * (width - len(row)) + row for row in ids],
+                "attention_mask": [[0] * (width - len(row)) + [1] * len(row) for row in ids],
+            },
+            tensor_type=kwargs.get("return_tensors"),
+        )
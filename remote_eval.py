@@ -0,0 +1,334 @@
+import json
+import random
+import asyncio
+import argparse
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+from data_loading import JOINT_ENTITY, LABEL_TO_STR, load_conll_dataset
+from metrics import MetricsAccumulator, extract_entities_from_xml, extract_typed_entities_from_xml
+
+STOP = "</entity>"
+JOINT_STOP = "</entities>"
+
+
+class RetryableError(Exception):
+    """A failed request that is worth sending again (rate limit, server error, dropped stream)"""
+
+
+class AsyncCompletionClient:
+    """
+        Asynchronous client for an OpenAI-compatible /v1/completions endpoint, such as
+        `vllm serve`, used in place of an in-process vllm.LLM.
+
+        All requests share one pooled aiohttp session and at most `max_concurrency` of
+        them are in flight at once. Responses are streamed, and a completion is cut off
+        as soon as it contains the stop string (`</entity>`, or `</entities>` for joint
+        prompts). Rate limits, 5xx responses and connection failures are retried with
+        jittered exponential backoff. A prompt that still fails after `max_retries`, or
+        gets a non-retryable error, gets empty completions and is counted in
+        stats["failed"], so one bad request does not lose the rest of the batch.
+
+        Calling the client with a list of prompts returns num_samples completion texts
+        per prompt, so it can serve as the `generate_fn` of ShardedEvalRunner. It owns
+        its own event loop for that, so the call blocks.
+    """
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        num_samples: int = 1,
+        temperature: float = 0.0,
+        max_tokens: int = 2048,
+        max_concurrency: int = 64,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        timeout: float = 600.0,
+        api_key: Optional[str] = None,
+        stop: str = STOP,
+    ):
+        self.url = base_url.rstrip("/") + "/v1/completions"
+        self.model = model
+        self.num_samples = num_samples
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.stop = stop
+
+        self.loop = asyncio.new_event_loop()
+        self.session: Optional[ClientSession] = None
+        self.stats = {"requests": 0, "retries": 0, "early_stops": 0, "failed": 0}
+
+    def _payload(self, prompt: str) -> Dict[str, object]:
+        # greedy decoding only ever needs one sample, see make_sampling_params in eval.py
+        n = 1 if self.temperature == 0.0 else self.num_samples
+        return {
+            "model": self.model,
+            "prompt": prompt,
+            "n": n,
+            "temperature": self.temperature,
+            "top_p": 0.8,
+            "max_tokens": self.max_tokens,
+            "stop": [self.stop],
+            "seed": 42,
+            "stream": True,
+            # vLLM extension; servers that ignore it get the tag re-added in _finish
+            "include_stop_str_in_output": True,
+        }
+
+    async def _session(self, ) -> ClientSession:
+        if self.session is None:
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.max_concurrency),
+                timeout=ClientTimeout(total=self.timeout),
+                headers=self.headers,
+            )
+        return self.session
+
+    def _finish(self, text: str, finish_reason: Optional[str]) -> str:
+        if self.stop in text:
+            return text[: text.index(self.stop) + len(self.stop)]
+        if finish_reason == "stop" and self.stop.replace("/", "") in text:
+            return text + self.stop
+        return text
+
+    async def _stream(self, payload: Dict[str, object]) -> List[str]:
+        session = await self._session()
+        texts: Dict[int, str] = {}
+        finish: Dict[int, Optional[str]] = {}
+
+        async with session.post(self.url, json=payload) as response:
+            if response.status == 429 or response.status >= 500:
+                raise RetryableError(f"{response.status}: {await response.text()}")
+            if response.status != 200:
+                raise RuntimeError(f"Completion request failed with {response.status}: {await response.text()}")
+
+            async for raw in response.content:
+                try:
+                    line = raw.decode("utf-8").strip()
+                except UnicodeDecodeError as e:
+                    raise RetryableError(f"Undecodable stream line {raw[:200]!r}") from e
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                # a truncated or garbled event is a transport fault like a dropped connection
+                try:
+                    choices = json.loads(data)["choices"]
+                except (ValueError, KeyError, TypeError) as e:
+                    raise RetryableError(f"Malformed stream event {data[:200]!r}") from e
+                for choice in choices:
+                    index = choice.get("index", 0)
+                    texts[index] = texts.get(index, "") + choice.get("text", "")
+                    if choice.get("finish_reason") is not None:
+                        finish[index] = choice["finish_reason"]
+
+                # stop reading once every choice has closed its entity list
+                if len(texts) == payload["n"] and all(self.stop in text or idx in finish for idx, text in texts.items()):
+                    if len(finish) < len(texts):
+                        self.stats["early_stops"] += 1
+                    break
+
+        # [DONE] or a dropped connection before every choice arrived
+        if len(texts) < payload["n"]:
+            raise RetryableError(f"Stream ended with {len(texts)} of {payload['n']} choices")
+
+        return [self._finish(texts.get(idx, ""), finish.get(idx)) for idx in range(payload["n"])]
+
+    async def complete(self, prompt: str, semaphore: asyncio.Semaphore) -> List[str]:
+        """num_samples completion texts for one prompt, all empty if the request failed"""
+        payload = self._payload(prompt)
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                self.stats["requests"] += 1
+                try:
+                    texts = await self._stream(payload)
+                    break
+                except (RetryableError, ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries:
+                        print(f"Completion request failed after {attempt + 1} attempts: {e!r}")
+                        self.stats["failed"] += 1
+                        return [""] * self.num_samples
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+                except RuntimeError as e:
+                    print(f"Completion request failed: {e}")
+                    self.stats["failed"] += 1
+                    return [""] * self.num_samples
+
+        if payload["n"] != self.num_samples:
+            texts = texts * self.num_samples
+        return texts
+
+    async def generate(self, prompts: Sequence[str]) -> List[List[str]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = [asyncio.ensure_future(self.complete(prompt, semaphore)) for prompt in prompts]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # an unexpected error or an interrupt: do not leave requests running on the loop
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def __call__(self, prompts: List[str]) -> List[List[str]]:
+        return self.loop.run_until_complete(self.generate(prompts))
+
+    def close(self, ):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+
+def predict_entities_remote(
+    client: AsyncCompletionClient,
+    dataset,
+    chunk_size: int = 1024,
+) -> Tuple[List[List[List[str]]], List[List[str]], MetricsAccumulator]:
+    """Predict entities for a dataset through an AsyncCompletionClient
+
+    Args:
+        client: Client for the inference server
+        dataset: Dataset containing columns titled 'prompt', 'answer' and 'entity'
+        chunk_size: Prompts submitted per batch; metrics are reported after each one
+
+    Returns:
+        Tuple of (predictions, ground_truths, accumulator) where predictions and
+        ground_truths are laid out as in predict_entities and accumulator holds the
+        streamed metrics.
+    """
+    accumulator = MetricsAccumulator(client.num_samples, tuple(LABEL_TO_STR.values()))
+    extract = extract_entities_from_xml
+    if len(dataset) and dataset[0]["entity"] == JOINT_ENTITY:
+        # joint completions are scored per entity type
+        extract = extract_typed_entities_from_xml
+    predictions = [[] for _ in range(client.num_samples)]
+    ground_truths = []
+
+    for start in range(0, len(dataset), chunk_size):
+        chunk = dataset[start : start + chunk_size]
+        texts = client([prompt[0]["content"] for prompt in chunk["prompt"]])
+
+        rows = [[extract(text) for text in row] for row in texts]
+        truths = [extract(answer) for answer in chunk["answer"]]
+        accumulator.update(rows, truths, chunk["entity"])
+        print(f"Evaluated {accumulator.summary()}")
+
+        for row in rows:
+            for sample, entities in zip(predictions, row):
+                sample.append(entities)
+        ground_truths.extend(truths)
+
+    print(
+        f"{client.stats['requests']} requests, {client.stats['retries']} retried, "
+        f"{client.stats['early_stops']} streams stopped early, {client.stats['failed']} failed"
+    )
+    return predictions, ground_truths, accumulator
+
+
+class FakeCompletionServer:
+    """
+        Local stand-in for an OpenAI-compatible completions server, for testing
+        AsyncCompletionClient without a GPU.
+
+        It streams a deterministic answer (the capitalised words of the prompt's last
+        `User:` turn, under every entity type when the request stops at `</entities>`),
+        keeps streaming filler past the stop string to check that the client stops on its
+        own, and fails a `fail_rate` fraction of requests with a 503.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, fail_rate: float = 0.0, delay: float = 0.0, seed: int = 0):
+        self.host = host
+        self.port = port
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def answer(prompt: str, stop: str = STOP) -> str:
+        context = prompt.rsplit("User:", 1)[-1].split("Assistant:", 1)[0]
+        words = ", ".join(word for word in context.split() if word[:1].isupper())
+        if stop == JOINT_STOP:
+            sections = " ".join(f"<{entity.lower()}>{words}</{entity.lower()}>" for entity in LABEL_TO_STR.values())
+            return f"<think> fake </think> <entities> {sections} {JOINT_STOP}"
+        return f"<think> fake </think> <entity>{words}{STOP}"
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        if self.random.random() < self.fail_rate:
+            return web.Response(status=503, text="injected failure")
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        pieces = self.answer(body["prompt"], (body.get("stop") or [STOP])[0]).split(" ") + ["filler"] * 50
+        try:
+            for position, piece in enumerate(pieces):
+                for index in range(body.get("n", 1)):
+                    chunk = {"choices": [{"index": index, "text": piece + " ", "finish_reason": None}]}
+                    await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+            await response.write(b"data: [DONE]\n\n")
+        except (ConnectionResetError, ClientError):
+            pass
+        return response
+
+    async def start(self, ) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/completions", self._completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{self.host}:{self.port}"
+
+    async def stop(self, ):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate against an OpenAI-compatible completions server")
+    parser.add_argument("--data", default="data/conll03/mrc-ner.test")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-1.5B-Instruct")
+    parser.add_argument("--num-samples", type=int, default=16)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--joint", action="store_true", help="one prompt per sentence for all entity types")
+    parser.add_argument("--fake-server", action="store_true", help="serve from a local FakeCompletionServer")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="failure rate of the fake server")
+    args = parser.parse_args()
+
+    test_df = load_conll_dataset(args.data, include_examples=True, compact=True, joint=args.joint)
+
+    client = AsyncCompletionClient(
+        args.base_url, args.model, args.num_samples, args.temperature, max_concurrency=args.max_concurrency,
+        stop=JOINT_STOP if args.joint else STOP,
+    )
+    server = None
+    if args.fake_server:
+        server = FakeCompletionServer(fail_rate=args.fail_rate)
+        client.url = client.loop.run_until_complete(server.start()) + "/v1/completions"
+
+    try:
+        predictions, ground_truths, accumulator = predict_entities_remote(client, test_df)
+    finally:
+        if server is not None:
+            client.loop.run_until_complete(server.stop())
+        client.close()
+
+    metrics = accumulator.metrics()
+    print(
+        f"Evaluation Metrics (F1): {metrics['f1_mean']} "
+        f"(95% CI {metrics['f1_ci_low']:.4f} - {metrics['f1_ci_high']:.4f})"
+    )
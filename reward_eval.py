@@ -0,0 +1,185 @@
+import os
+import math
+import hashlib
+import multiprocessing
+
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+from profiling import TIMER
+from reward_worker import score_chunk
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def subset_kwargs(kwargs: Dict[str, object], indices: List[int], size: int) -> Dict[str, object]:
+    """Slices every per-completion list in kwargs down to `indices`, leaving other values as they are"""
+    return {
+        key: [value[idx] for idx in indices] if isinstance(value, list) and len(value) == size else value
+        for key, value in kwargs.items()
+    }
+
+
+class RewardExecutor:
+    """
+        Runs reward functions concurrently across chunks of completions.
+
+        mode="process" keeps a persistent spawn-based process pool, which is what pure
+        Python verifiers need to get past the GIL. The reward functions must then be
+        importable module-level functions, and each chunk is one task that runs them all
+        through reward_worker.score_chunk. Workers import only reward_worker, the reward
+        modules and the main script, which is why train.py keeps its heavy imports in main.
+        mode="thread" uses a thread pool, for verifiers that release the GIL or wait on
+        I/O. mode="inline" calls every function on the whole batch in the trainer process.
+
+        A batch is split into one chunk per worker unless `chunk_size` is given. Every
+        pooled call pays a pickling round trip, so the pools only pay off when scoring a
+        batch costs well over that, as with slow verifiers or large deduplicated batches.
+        The rewards in rewards.py score a trainer micro-batch in well under a
+        millisecond, which is why train.py defaults to inline.
+
+        Results come back as one list per function, in completion order, which is the
+        shape GRPOTrainer expects from each reward function. The time each function
+        spends is recorded as stage `reward/fn/<name>`, summed over chunks.
+    """
+    def __init__(self, mode: str = "process", max_workers: Optional[int] = None, chunk_size: Optional[int] = None):
+        if mode not in ("process", "thread", "inline"):
+            raise ValueError(f"{mode} is not a recognized reward execution mode")
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.pool: Optional[Executor] = None
+
+        if mode == "process":
+            # fork would copy the trainer's CUDA state into the workers
+            self.pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        elif mode == "thread":
+            self.pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="reward")
+
+    def run(self, funcs: List[Callable], prompts, completions, kwargs) -> List[List[float]]:
+        if self.pool is None:
+            return self._collect(funcs, [score_chunk(funcs, prompts, completions, kwargs)])
+
+        # one task per chunk: the chunk is pickled once and parsed once for all functions
+        size = len(completions)
+        chunk_size = self.chunk_size or max(1, math.ceil(size / self.max_workers))
+        chunks = [list(range(start, min(start + chunk_size, size))) for start in range(0, size, chunk_size)]
+        futures = [
+            self.pool.submit(
+                score_chunk,
+                funcs,
+                [prompts[idx] for idx in chunk],
+                [completions[idx] for idx in chunk],
+                subset_kwargs(kwargs, chunk, size),
+            )
+            for chunk in chunks
+        ]
+        return self._collect(funcs, [future.result() for future in futures])
+
+    @staticmethod
+    def _collect(funcs: List[Callable], results: List[List[Tuple[List[float], float]]]) -> List[List[float]]:
+        """Joins per-chunk results, each holding one (rewards, seconds) pair per function, into one list per function"""
+        columns = []
+        for position, func in enumerate(funcs):
+            TIMER.record(f"reward/fn/{func.__name__}", sum(chunk[position][1] for chunk in results))
+            columns.append([reward for chunk in results for reward in chunk[position][0]])
+        return columns
+
+    def shutdown(self, ):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class CachedRewardEvaluator:
+    """
+        Deduplicating, memoising front end for the reward functions handed to GRPOTrainer.
+
+        On the first reward call of a step, every completion is keyed by (answer hash,
+        completion hash). Each distinct key that is not already in the LRU cache is
+        scored once by every reward function, and the reward vectors are cached. The
+        per-function callables from `reward_funcs` then read their column from the result.
+
+        This assumes rewards depend only on the answer and the completion text, which
+        holds for every function in rewards.py. The misses are scored through `executor`,
+        which runs inline unless a pooled RewardExecutor is given.
+    """
+    def __init__(self, reward_funcs: List[Callable], maxsize: int = 100_000, executor: Optional[RewardExecutor] = None):
+        self.funcs = list(reward_funcs)
+        self.maxsize = maxsize
+        self.executor = executor or RewardExecutor("inline")
+        self.cache: "OrderedDict[Tuple[bytes, bytes], Tuple[float, ...]]" = OrderedDict()
+
+        self._completions = None
+        self._rewards: List[Tuple[float, ...]] = []
+        self._counts = {"completions": 0, "unique": 0, "cache_hits": 0}
+
+    def reward_funcs(self, ) -> List[Callable]:
+        """One callable per reward function, named like it so GRPOTrainer logs the same keys"""
+        def column(position, func):
+            @wraps(func)
+            def reward(prompts, completions, **kwargs):
+                rewards = self.evaluate(prompts, completions, **kwargs)
+                return [vector[position] for vector in rewards]
+            return reward
+
+        return [column(position, func) for position, func in enumerate(self.funcs)]
+
+    def evaluate(self, prompts, completions, **kwargs) -> List[Tuple[float, ...]]:
+        """Reward vectors for a batch, computed at most once per completions list"""
+        if completions is self._completions:
+            return self._rewards
+
+        answer = kwargs.get("answer") or [""] * len(completions)
+        keys = [
+            (_digest(str(ans)), _digest(completion[0]["content"]))
+            for ans, completion in zip(answer, completions)
+        ]
+
+        first_seen: Dict[Tuple[bytes, bytes], int] = {}
+        for idx, key in enumerate(keys):
+            first_seen.setdefault(key, idx)
+        misses = [idx for key, idx in first_seen.items() if key not in self.cache]
+
+        self._counts["completions"] += len(keys)
+        self._counts["unique"] += len(first_seen)
+        self._counts["cache_hits"] += len(first_seen) - len(misses)
+
+        if misses:
+            columns = self.score(
+                [prompts[idx] for idx in misses],
+                [completions[idx] for idx in misses],
+                subset_kwargs(kwargs, misses, len(completions)),
+            )
+            for row, idx in enumerate(misses):
+                self.cache[keys[idx]] = tuple(column[row] for column in columns)
+
+        rewards = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            rewards.append(self.cache[key])
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+        self._completions, self._rewards = completions, rewards
+        return rewards
+
+    def score(self, prompts, completions, kwargs) -> List[List[float]]:
+        """Runs every reward function over the given completions, one column per function"""
+        with TIMER.stage("reward/score"):
+            return self.executor.run(self.funcs, prompts, completions, kwargs)
+
+    def pop_metrics(self, ) -> Dict[str, float]:
+        """Dedup and cache hit rates since the last call, for MetricsCallback"""
+        counts = self._counts
+        self._counts = {"completions": 0, "unique": 0, "cache_hits": 0}
+        if not counts["completions"]:
+            return {}
+        return {
+            "reward_cache/duplicate_rate": 1 - counts["unique"] / counts["completions"],
+            "reward_cache/hit_rate": counts["cache_hits"] / counts["unique"],
+            "reward_cache/scored_fraction": (counts["unique"] - counts["cache_hits"]) / counts["completions"],
+            "reward_cache/size": len(self.cache),
+        }
@@ -0,0 +1,169 @@
+import os
+import glob
+import gzip
+import json
+import time
+import queue
+import hashlib
+import threading
+
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional
+
+
+class RewardDebugSink:
+    """
+        Non-blocking sink for reward debugging records.
+
+        Reward functions wrapped with `wrap` report their rewards here. For every
+        `every_n_steps`-th batch, the first prompt group is turned into one record: prompt
+        hash, answer, responses and the rewards from each function. The record is pushed
+        onto a bounded queue and written as gzip-compressed JSONL by a background thread,
+        so the trainer never waits on the filesystem. When the queue is full, records are
+        dropped and counted instead.
+
+        Files are `<path>.jsonl.gz`, rotated to `<path>.1.jsonl.gz`, `<path>.2.jsonl.gz`, ...
+        once they pass `max_bytes`, and only `backups` rotated files are kept. Rotation is
+        not shared between processes, so every rank needs its own path.
+    """
+    def __init__(
+        self,
+        path: str,
+        every_n_steps: int = 10,
+        max_bytes: int = 64 << 20,
+        backups: int = 5,
+        queue_size: int = 256,
+    ):
+        self.path = path
+        self.every_n_steps = every_n_steps
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+
+        self._queue: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=queue_size)
+        self._step = -1
+        self._completions = None
+        self._pending: Optional[Dict[str, list]] = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="reward-debug-writer", daemon=True)
+        self._thread.start()
+
+    def wrap(self, reward_funcs: List[Callable]) -> List[Callable]:
+        """Returns the reward functions with their outputs reported to this sink"""
+        names = [func.__name__ for func in reward_funcs]
+
+        def report(func):
+            @wraps(func)
+            def wrapped(prompts, completions, **kwargs):
+                rewards = func(prompts=prompts, completions=completions, **kwargs)
+                self._collect(func.__name__, names, prompts, completions, kwargs, rewards)
+                return rewards
+            return wrapped
+
+        return [report(func) for func in reward_funcs]
+
+    def _collect(self, name, names, prompts, completions, kwargs, rewards):
+        if completions is not self._completions:
+            # the first function to see a new completions list opens a new step
+            self._completions = completions
+            self._step += 1
+            self._pending = {} if self._step % self.every_n_steps == 0 else None
+        if self._pending is None:
+            return
+
+        group = [idx for idx, prompt in enumerate(prompts) if prompt == prompts[0]]
+        self._pending[name] = [rewards[idx] for idx in group]
+        if len(self._pending) < len(names):
+            return
+
+        answer = kwargs.get("answer")
+        prompt = prompts[0][-1]["content"] if isinstance(prompts[0], list) else prompts[0]
+        self.log({
+            "step": self._step,
+            "time": time.time(),
+            "prompt_hash": hashlib.sha1(prompt.encode("utf-8")).hexdigest(),
+            "answer": answer[0] if answer else None,
+            "responses": [completions[idx][0]["content"] for idx in group],
+            "rewards": self._pending,
+        })
+        self._pending = None
+
+    def log(self, record: dict) -> bool:
+        """Queues a record without blocking. Returns False if it had to be dropped"""
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _file_path(self, index: int) -> str:
+        return f"{self.path}.jsonl.gz" if index == 0 else f"{self.path}.{index}.jsonl.gz"
+
+    def _rotate(self, ):
+        # shifting each file up one index overwrites the oldest backup
+        for index in range(self.backups, 0, -1):
+            if os.path.exists(self._file_path(index - 1)):
+                os.replace(self._file_path(index - 1), self._file_path(index))
+
+    def _run(self, ):
+        raw = open(self._file_path(0), "ab")
+        out = gzip.GzipFile(fileobj=raw, mode="ab")
+
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            out.write((json.dumps(record) + "\n").encode("utf-8"))
+
+            if self._queue.empty():
+                # make what has been written so far readable without closing the file
+                out.flush()
+            if raw.tell() >= self.max_bytes:
+                out.close()
+                raw.close()
+                self._rotate()
+                raw = open(self._file_path(0), "ab")
+                out = gzip.GzipFile(fileobj=raw, mode="ab")
+
+        out.close()
+        raw.close()
+
+    def close(self, timeout: float = 30.0):
+        """
+            Writes out everything still queued and stops the writer thread. Waits at most
+            `timeout` seconds for the queue and for the thread, so a writer that died or
+            hangs cannot keep the process from exiting; the thread is a daemon.
+        """
+        if not self._thread.is_alive():
+            print(f"Reward debug writer for {self.path} had stopped; queued records are lost")
+        else:
+            try:
+                self._queue.put(None, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:
+                pass
+            if self._thread.is_alive():
+                print(f"Reward debug writer for {self.path} did not finish within {timeout}s; leaving it behind")
+        if self.dropped:
+            print(f"Reward debug sink dropped {self.dropped} records")
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """Reads back every record written under `path`, oldest file first"""
+    rotated = {}
+    for name in glob.glob(f"{glob.escape(path)}.*.jsonl.gz"):
+        index = name[len(path) + 1 : -len(".jsonl.gz")]
+        if index.isdigit():
+            rotated[int(index)] = name
+    files = [rotated[index] for index in sorted(rotated, reverse=True)]
+    files.append(f"{path}.jsonl.gz")
+
+    for name in files:
+        if not os.path.exists(name):
+            continue
+        with gzip.open(name, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
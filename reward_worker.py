@@ -0,0 +1,23 @@
+"""
+    Entry point of the RewardExecutor worker processes. Spawned workers import this
+    module and the module of each reward function, so it must stay free of torch, trl
+    and the other training imports.
+"""
+import time
+
+from typing import Callable, List, Tuple
+
+
+def score_chunk(funcs: List[Callable], prompts, completions, kwargs) -> List[Tuple[List[float], float]]:
+    """
+        Runs every reward function over one chunk, returning each function's rewards and
+        the seconds it took. All functions get the same lists, so the per-step
+        memoisation in rewards.py parses the chunk once for all of them.
+    """
+    results = []
+    for func in funcs:
+        # timed where it runs, so pooled workers report their own time
+        start = time.perf_counter()
+        rewards = list(func(prompts=prompts, completions=completions, **kwargs))
+        results.append((rewards, time.perf_counter() - start))
+    return results
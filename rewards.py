@@ -1,15 +1,112 @@
 import re
-import os
 
-from typing import List
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+FORMAT_PATTERN = re.compile(r"<think>.*?</think>\s*<entity>.*?</entity>", re.DOTALL)
+THINK_PATTERN = re.compile(r"<think>(.*?)</think>", re.DOTALL)
+ENTITY_PATTERN = re.compile(r"<entity>(.*?)</entity>")
+
+
+class ParsedCompletion(NamedTuple):
+    """Everything the reward functions read from one completion"""
+    response: str
+    format_ok: bool
+    think: Optional[str]
+    answer: str
+    entities: Tuple[str, ...]
+
+
+def parse_completion(response: str) -> ParsedCompletion:
+    think = THINK_PATTERN.search(response)
+    answer = extract_xml_answer(response)
+    return ParsedCompletion(
+        response=response,
+        format_ok=FORMAT_PATTERN.match(response) is not None,
+        think=think.group(1) if think else None,
+        answer=answer,
+        entities=tuple(extract_entity_contents(answer)),
+    )
+
+
+# GRPOTrainer hands the same completions list to every reward function of a step,
+# so the parse of the last list seen is kept and reused until a new one arrives.
+_last_parsed: Tuple[Optional[list], List[ParsedCompletion]] = (None, [])
+
+
+def parse_completions(completions) -> List[ParsedCompletion]:
+    """Parses every completion of a batch once, memoised for the current trainer step"""
+    global _last_parsed
+    last_completions, parsed = _last_parsed
+    if completions is not last_completions:
+        parsed = [parse_completion(completion[0]["content"]) for completion in completions]
+        _last_parsed = (completions, parsed)
+    return parsed
+
+
+@lru_cache(maxsize=4096)
+def answer_entities(answer: str) -> Tuple[str, ...]:
+    """Ground truth entities of an answer string; answers repeat across a group, so this is cached"""
+    return tuple(extract_entity_contents(answer))
+
+
+class GroupScores(NamedTuple):
+    """Per-completion entity rewards for a batch, in completion order"""
+    positive: List[float]
+    negative: List[float]
+    exact: List[float]
+
+
+def score_entity_groups(answer: Sequence[str], parsed: Sequence[ParsedCompletion]) -> GroupScores:
+    """
+    Scores a batch against its answers, one prompt group at a time.
+
+    Completions are grouped by answer string. Each group's ground truth is counted
+    once, and every completion in the group is then scored with hash lookups instead
+    of list membership. Duplicates count as they do in positive_entity_score_func and
+    negative_entity_score_func: a repeated answer entity earns 0.5 per repeat when it
+    appears in the output at all, and a repeated wrong output entity costs 0.5 per repeat.
+    """
+    groups: Dict[str, List[int]] = {}
+    for idx, ans in enumerate(answer):
+        groups.setdefault(str(ans), []).append(idx)
+
+    positive = [0.0] * len(parsed)
+    negative = [0.0] * len(parsed)
+    exact = [0.0] * len(parsed)
+
+    for ans, indices in groups.items():
+        answer_counts = Counter(answer_entities(ans))
+        for idx in indices:
+            out_entities = parsed[idx].entities
+            out_set = set(out_entities)
+            hits = sum(count for entity, count in answer_counts.items() if entity in out_set)
+            misses = sum(1 for entity in out_entities if entity not in answer_counts)
+            positive[idx] = 0.5 * hits
+            negative[idx] = 0.0 - 0.5 * misses
+            exact[idx] = 2.0 if parsed[idx].answer == ans else 0.0
+
+    return GroupScores(positive, negative, exact)
+
+
+# the positive, negative and exact-match rewards of a step share one scoring pass
+_last_scores: Tuple[Optional[list], Optional[list], Optional[GroupScores]] = (None, None, None)
+
+
+def group_scores(completions, answer) -> GroupScores:
+    """score_entity_groups over parse_completions, memoised like it for the current step"""
+    global _last_scores
+    last_completions, last_answer, scores = _last_scores
+    if completions is not last_completions or list(answer) != last_answer:
+        scores = score_entity_groups(answer, parse_completions(completions))
+        _last_scores = (completions, list(answer), scores)
+    return scores
 
 
 def soft_format_reward_func(completions, **kwargs) -> list[float]:
     """Reward function that checks if the completion has a specific format."""
-    pattern = r"<think>.*?</think>\s*<entity>.*?</entity>"
-    responses = [completion[0]["content"] for completion in completions]
-    matches = [re.match(pattern, r, flags=re.DOTALL) for r in responses] 
-    return [0.5 if match else 0.0 for match in matches]
+    return [0.5 if parsed.format_ok else 0.0 for parsed in parse_completions(completions)]
 
 def extract_xml_answer(text: str) -> str:
     answer = text.split("<think>")[-1]
@@ -18,48 +115,18 @@ def extract_xml_answer(text: str) -> str:
 
 def correctness_reward_func(prompts, completions, answer, **kwargs) -> list[float]:
     """Checks if the generation of the model exactly matches the ground truth"""
-    responses = [completion[0]['content'] for completion in completions]
-    q = prompts[0][-1]['content']
-    extracted_responses = [extract_xml_answer(r) for r in responses]
-
-    # ---------- LOGS -----------------------------
-    debug_content = (
-        f"\n{'-'*20}"
-        f"\nQuestion:\n{q}"
-        f"\nAnswer:\n{answer[0]}"
-        f"\nResponse:\n{responses[0]}"
-        f"\nExtracted:\n{extracted_responses[0]}\n"
-    )
-    
-    file_path = f"logs/qwen2.5B-1.5_experiment3.txt"
-
-    if not os.path.exists(file_path):
-        with open(file_path, "w", encoding="utf-8") as f:
-            pass 
-    
-    with open(file_path, "a", encoding="utf-8") as f:
-        f.write(debug_content)
-    rewards = [2.0 if r == str(a) else 0.0 for r, a in zip(extracted_responses, answer)]
+    rewards = list(group_scores(completions, answer).exact)
     return rewards
 
 def positive_entity_score_func(answer_entity_list: List[str], out_entity_list: List[str]) -> float:
     """Assigns 0.5 to correct entities included in the list of entities"""
-    score = 0.0
-
-    for entity in answer_entity_list:
-        score += 0.5 if entity in out_entity_list else 0.0
-
-    return score
+    out_entities = set(out_entity_list)
+    return 0.5 * sum(1 for entity in answer_entity_list if entity in out_entities)
 
 def negative_entity_score_func(answer_entity_list: List[str], out_entity_list: List[str]) -> float:
     """Penalizes entities in the generation that are not in the ground truth"""
-    score = 0.0
-
-    for entity in out_entity_list:
-        if entity not in answer_entity_list:
-            score -= 0.5 
-
-    return score
+    answer_set = set(answer_entity_list)
+    return 0.0 - 0.5 * sum(1 for entity in out_entity_list if entity not in answer_set)
 
 def extract_entity_contents(input_string: str) -> List[str]:
     """
@@ -73,8 +140,7 @@ def extract_entity_contents(input_string: str) -> List[str]:
         list: A list of words split by commas from within the entity tags.
               Returns an empty list if the entity content is empty.
     """
-    pattern = r"<entity>(.*?)</entity>"
-    matches = re.findall(pattern, input_string)
+    matches = ENTITY_PATTERN.findall(input_string)
     
     if not matches:
         return []  
@@ -86,15 +152,121 @@ def extract_entity_contents(input_string: str) -> List[str]:
 
 
 def positive_entity_correctness_reward_func(prompts, completions, answer, **kwargs) -> List[float]:
-    responses = [completion[0]['content'] for completion in completions]
-    extracted_responses = [extract_xml_answer(r) for r in responses]
-
-    result = [positive_entity_score_func(extract_entity_contents(ans), extract_entity_contents(res)) for ans, res in zip(answer, extracted_responses)]
+    result = list(group_scores(completions, answer).positive)
     return result
 
 def negative_entity_correctness_reward_func(prompts, completions, answer, **kwargs) -> List[float]:
-    responses = [completion[0]['content'] for completion in completions]
-    extracted_responses = [extract_xml_answer(r) for r in responses]
+    result = list(group_scores(completions, answer).negative)
+    return result
+
+# Joint mode: one completion tags every entity type, in the order of the joint prompts, as
+# <entities> <person>...</person> <location>...</location> ... </entities>
+JOINT_TYPE_TAGS = ("person", "location", "organization", "miscellaneous")
+JOINT_FORMAT_PATTERN = re.compile(
+    r"<think>.*?</think>\s*<entities>\s*"
+    + "".join(rf"<{tag}>[^<]*</{tag}>\s*" for tag in JOINT_TYPE_TAGS)
+    + r"</entities>",
+    re.DOTALL,
+)
+JOINT_ANSWER_PATTERN = re.compile(r"<entities>(.*?)</entities>", re.DOTALL)
+TYPE_SECTION_PATTERN = re.compile(r"<(\w+)>(.*?)</\1>", re.DOTALL)
+
+
+def extract_typed_entity_contents(input_string: str) -> Dict[str, Tuple[str, ...]]:
+    """
+    Extracts the entities of every type tag in a joint answer, keyed by entity type
+    ("person" -> "Person"). Only the inside of the entities tag is read, or the whole
+    answer if it has none, and each section's content is split like extract_entity_contents.
+    """
+    answer = extract_xml_answer(input_string)
+    wrapped = JOINT_ANSWER_PATTERN.search(answer)
+    sections: Dict[str, List[str]] = {}
+    for tag, content in TYPE_SECTION_PATTERN.findall(wrapped.group(1) if wrapped else answer):
+        words = [word.strip() for word in content.split(",") if word.strip()]
+        sections.setdefault(tag.capitalize(), []).extend(words)
+    return {entity: tuple(words) for entity, words in sections.items()}
+
+
+@lru_cache(maxsize=4096)
+def joint_answer_entities(answer: str) -> Dict[str, Tuple[str, ...]]:
+    return extract_typed_entity_contents(answer)
+
+
+def _type_answer(entities: Sequence[str]) -> str:
+    # canonical single-type answer, so exact matching compares entity lists
+    return "<entity>" + ", ".join(entities) + "</entity>"
+
+
+def score_joint_groups(answer: Sequence[str], responses: Sequence[str]) -> GroupScores:
+    """
+    Scores joint completions with the per-type rewards. Each entity type present in the
+    answers or the completions is scored by score_entity_groups as if it were its own
+    single-type completion. Positive and negative scores are summed over types. The
+    exact-match score is the mean over the types that have entities in the answer or the
+    completion, or that the completion left out, so it stays on the single-type 0-2
+    scale: empty tags earn nothing and a missing tag is a miss. A sentence without
+    entities needs every type tagged and empty to score 2.
+    """
+    answers = [joint_answer_entities(str(ans)) for ans in answer]
+    outputs = [extract_typed_entity_contents(response) for response in responses]
+    types = sorted({entity for sections in answers + outputs for entity in sections})
+
+    positive = [0.0] * len(responses)
+    negative = [0.0] * len(responses)
+    exact: List[Dict[str, float]] = [{} for _ in responses]
+
+    for entity in types:
+        type_answers = [_type_answer(sections.get(entity, ())) for sections in answers]
+        type_parsed = [
+            ParsedCompletion(
+                response=response,
+                format_ok=True,
+                think=None,
+                # a type the completion left out cannot match exactly, even when its answer is empty
+                answer=_type_answer(sections[entity]) if entity in sections else "",
+                entities=sections.get(entity, ()),
+            )
+            for response, sections in zip(responses, outputs)
+        ]
+        scores = score_entity_groups(type_answers, type_parsed)
+        for idx in range(len(responses)):
+            positive[idx] += scores.positive[idx]
+            negative[idx] += scores.negative[idx]
+            exact[idx][entity] = scores.exact[idx]
+
+    exact_mean = []
+    for truth, output, type_exact in zip(answers, outputs, exact):
+        scored = [entity for entity in types if truth.get(entity) or output.get(entity) or entity not in output] or types
+        exact_mean.append(sum(type_exact[entity] for entity in scored) / len(scored) if scored else 0.0)
+
+    return GroupScores(positive, negative, exact_mean)
+
+
+_last_joint_scores: Tuple[Optional[list], Optional[list], Optional[GroupScores]] = (None, None, None)
+
+
+def joint_group_scores(completions, answer) -> GroupScores:
+    """score_joint_groups, memoised for the current step like group_scores"""
+    global _last_joint_scores
+    last_completions, last_answer, scores = _last_joint_scores
+    if completions is not last_completions or list(answer) != last_answer:
+        scores = score_joint_groups(answer, [completion[0]["content"] for completion in completions])
+        _last_joint_scores = (completions, list(answer), scores)
+    return scores
+
+
+def joint_format_reward_func(completions, **kwargs) -> List[float]:
+    """Reward function that checks if the completion has the joint format"""
+    return [
+        0.5 if JOINT_FORMAT_PATTERN.match(completion[0]["content"]) else 0.0
+        for completion in completions
+    ]
+
+def joint_correctness_reward_func(prompts, completions, answer, **kwargs) -> List[float]:
+    return list(joint_group_scores(completions, answer).exact)
+
+def joint_positive_entity_correctness_reward_func(prompts, completions, answer, **kwargs) -> List[float]:
+    return list(joint_group_scores(completions, answer).positive)
 
-    result = [negative_entity_score_func(extract_entity_contents(ans), extract_entity_contents(res)) for ans, res in zip(answer, extracted_responses)]
-    return result
\ No newline at end of file
+def joint_negative_entity_correctness_reward_func(prompts, completions, answer, **kwargs) -> List[float]:
+    return list(joint_group_scores(completions, answer).negative)
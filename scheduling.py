@@ -0,0 +1,143 @@
+import time
+import bisect
+
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Sequence
+
+
+def order_by_shared_prefix(prompts: List[str]) -> List[int]:
+    """Order in which to submit prompts so that prompts sharing a prefix run back to back.
+
+    Sorting the prompt strings places every prompt next to the one it shares the longest
+    prefix with, so all prompts built from the same template, entity type and few-shot
+    block form one contiguous run that the engine's prefix cache can serve.
+
+    Args:
+        prompts: Prompt strings in dataset order
+    Returns:
+        Indices into prompts, in submission order
+    """
+    return sorted(range(len(prompts)), key=prompts.__getitem__)
+
+
+class CompletionBudget:
+    """Per-key max_tokens estimate from the completion lengths observed so far
+
+    Until `min_observations` completions of a key have been seen, the estimate is `initial`.
+    After that it is the `quantile` of the last `window` lengths times `margin`.
+    Estimates are clipped to [floor, cap].
+    """
+    def __init__(
+        self,
+        initial: int = 512,
+        cap: int = 2048,
+        floor: int = 64,
+        quantile: float = 0.95,
+        margin: float = 1.25,
+        window: int = 2000,
+        min_observations: int = 32,
+    ):
+        self.initial = initial
+        self.cap = cap
+        self.floor = floor
+        self.quantile = quantile
+        self.margin = margin
+        self.min_observations = min_observations
+        self.lengths: Dict[str, Deque[int]] = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, key: str, length: int):
+        self.lengths[key].append(length)
+
+    def estimate(self, key: str) -> int:
+        lengths = self.lengths[key]
+        if len(lengths) < self.min_observations:
+            budget = self.initial
+        else:
+            ordered = sorted(lengths)
+            budget = int(ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))] * self.margin)
+        return max(self.floor, min(self.cap, budget))
+
+
+class BucketScheduler:
+    """Length-bucketed, budget-aware submission of evaluation prompts
+
+    Prompts are grouped into buckets by token length and each bucket is submitted as its
+    own engine call, with prompts ordered by shared prefix inside it. Every request gets
+    max_tokens from the CompletionBudget of its key (the entity type), capped by what is
+    left of max_model_len. Requests that stop because they hit max_tokens are retried with
+    double the budget until they finish or reach the cap. Throughput is recorded per bucket
+    in `stats`.
+    """
+    def __init__(
+        self,
+        budget: Optional[CompletionBudget] = None,
+        boundaries: Sequence[int] = (256, 512, 1024),
+        max_model_len: int = 2048,
+    ):
+        self.budget = budget or CompletionBudget(cap=max_model_len)
+        self.boundaries = list(boundaries)
+        self.max_model_len = max_model_len
+        self.stats: List[Dict[str, float]] = []
+
+    def bucket_of(self, length: int) -> int:
+        return bisect.bisect_left(self.boundaries, length)
+
+    def _bucket_name(self, bucket: int) -> str:
+        low = self.boundaries[bucket - 1] + 1 if bucket > 0 else 0
+        high = self.boundaries[bucket] if bucket < len(self.boundaries) else self.max_model_len
+        return f"{low}-{high}"
+
+    def _params(self, sampling_params, max_tokens: int):
+        params = sampling_params.clone()
+        params.max_tokens = max_tokens
+        return params
+
+    def run(self, model, prompts: List[str], engine_prompts: list, prompt_lengths: List[int], sampling_params, keys: List[str]):
+        """Generates for every prompt and returns one RequestOutput per prompt, in the given order"""
+        buckets: Dict[int, List[int]] = defaultdict(list)
+        for idx in order_by_shared_prefix(prompts):
+            buckets[self.bucket_of(prompt_lengths[idx])].append(idx)
+
+        outputs = [None] * len(prompts)
+        for bucket in sorted(buckets):
+            indices = buckets[bucket]
+            room = {idx: max(1, self.max_model_len - prompt_lengths[idx]) for idx in indices}
+            max_tokens = {idx: min(room[idx], self.budget.estimate(keys[idx])) for idx in indices}
+            start, retries, pending = time.perf_counter(), 0, indices
+
+            while pending:
+                results = model.generate(
+                    [engine_prompts[idx] for idx in pending],
+                    [self._params(sampling_params, max_tokens[idx]) for idx in pending],
+                )
+                truncated = []
+                for idx, output in zip(pending, results):
+                    outputs[idx] = output
+                    hit_limit = any(out.finish_reason == "length" for out in output.outputs)
+                    if hit_limit and max_tokens[idx] < room[idx]:
+                        max_tokens[idx] = min(room[idx], max_tokens[idx] * 2)
+                        truncated.append(idx)
+                    else:
+                        for out in output.outputs:
+                            self.budget.observe(keys[idx], len(out.token_ids))
+                retries += len(truncated)
+                pending = truncated
+
+            elapsed = time.perf_counter() - start
+            generated = sum(len(out.token_ids) for idx in indices for out in outputs[idx].outputs)
+            self.stats.append({
+                'bucket': self._bucket_name(bucket),
+                'requests': len(indices),
+                'prompt_tokens': sum(prompt_lengths[idx] for idx in indices),
+                'generated_tokens': generated,
+                'retries': retries,
+                'seconds': elapsed,
+                'requests_per_s': len(indices) / elapsed if elapsed > 0 else 0,
+                'generated_tokens_per_s': generated / elapsed if elapsed > 0 else 0,
+            })
+            print(
+                f"Bucket {self._bucket_name(bucket)}: {len(indices)} requests, {retries} retried, "
+                f"{self.stats[-1]['requests_per_s']:.1f} req/s, "
+                f"{self.stats[-1]['generated_tokens_per_s']:.0f} generated tok/s"
+            )
+        return outputs
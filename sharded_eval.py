@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import argparse
+
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Sequence
+from functools import partial
+from data_loading import JOINT_ENTITY, LABEL_TO_STR, load_conll_dataset
+from metrics import MetricsAccumulator, extract_entities_from_xml, extract_typed_entities_from_xml
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+
+GenerateFn = Callable[[List[str]], List[List[str]]]
+
+
+def stub_generate(prompts: List[str], joint: bool = False) -> List[List[str]]:
+    """CPU stand-in for the engine: tags the capitalised words of the context as entities (of every type if joint)"""
+    texts = []
+    for prompt in prompts:
+        context = prompt.rsplit("User:", 1)[-1].split("Assistant:", 1)[0]
+        words = ", ".join(word for word in context.split() if word[:1].isupper())
+        if joint:
+            sections = " ".join(f"<{entity.lower()}>{words}</{entity.lower()}>" for entity in LABEL_TO_STR.values())
+            texts.append([f"<think> stub </think> <entities> {sections} </entities>"])
+        else:
+            texts.append([f"<think> stub </think> <entity>{words}</entity>"])
+    return texts
+
+
+class ShardedEvalRunner:
+    """
+        Splits the evaluation set into `num_shards` contiguous shards and generates them
+        with `generate_fn`, checkpointing as it goes.
+
+        Every shard appends one JSONL line per row (row index, entity type, answer and the
+        completion texts) to `<out_dir>/shard-XXXXX.jsonl` after each chunk, and writes a
+        `.done` marker once complete. Rerunning skips finished shards and resumes unfinished
+        ones after their last complete line. Shards can be split across processes or nodes
+        with `rank`/`world_size`, as long as they all share `out_dir`.
+
+        While a shard runs, its metrics are accumulated and reported after every chunk.
+        A finished shard leaves its MetricsAccumulator state in `shard-XXXXX.metrics.json`,
+        and `merge` combines those into the final metrics.
+
+        The shard count and dataset size are written to `<out_dir>/manifest.json`, so
+        `from_manifest` can reopen the generations without the dataset.
+    """
+    def __init__(
+        self,
+        dataset: "Dataset",
+        generate_fn: GenerateFn,
+        out_dir: str,
+        num_shards: int,
+        chunk_size: int = 256,
+    ):
+        self.dataset = dataset
+        self.generate_fn = generate_fn
+        self.out_dir = out_dir
+        self.num_shards = num_shards
+        self.chunk_size = chunk_size
+        os.makedirs(out_dir, exist_ok=True)
+        if dataset is not None:
+            self._write_manifest()
+
+    def _manifest_path(self, ) -> str:
+        return os.path.join(self.out_dir, "manifest.json")
+
+    def _write_manifest(self, ):
+        manifest = {"num_shards": self.num_shards, "num_rows": len(self.dataset)}
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                existing = json.load(f)
+            if existing != manifest:
+                raise ValueError(f"{self.out_dir} holds generations for {existing}, not {manifest}")
+            return
+        tmp = f"{self._manifest_path()}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._manifest_path())
+
+    @classmethod
+    def from_manifest(cls, out_dir: str) -> "ShardedEvalRunner":
+        """A runner over the generations in out_dir, for reading and scoring them without the dataset"""
+        path = os.path.join(out_dir, "manifest.json")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No manifest.json in {out_dir}; was it written by ShardedEvalRunner?")
+        with open(path) as f:
+            manifest = json.load(f)
+        return cls(None, None, out_dir, manifest["num_shards"])
+
+    def shard_rows(self, shard: int) -> range:
+        size = len(self.dataset)
+        return range(shard * size // self.num_shards, (shard + 1) * size // self.num_shards)
+
+    def _path(self, shard: int) -> str:
+        return os.path.join(self.out_dir, f"shard-{shard:05d}.jsonl")
+
+    def _done_path(self, shard: int) -> str:
+        return self._path(shard) + ".done"
+
+    def _metrics_path(self, shard: int) -> str:
+        return os.path.join(self.out_dir, f"shard-{shard:05d}.metrics.json")
+
+    def _records(self, shard: int) -> Iterator[dict]:
+        if os.path.exists(self._path(shard)):
+            with open(self._path(shard), encoding="utf-8") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        yield json.loads(line)
+
+    def _accumulate(self, accumulator: Optional[MetricsAccumulator], records: List[dict]) -> Optional[MetricsAccumulator]:
+        if not records:
+            return accumulator
+        if accumulator is None:
+            accumulator = MetricsAccumulator(len(records[0]["completions"]), tuple(LABEL_TO_STR.values()))
+        # joint rows are scored per entity type from their single completion
+        extract = extract_typed_entities_from_xml if records[0]["entity"] == JOINT_ENTITY else extract_entities_from_xml
+        accumulator.update(
+            [[extract(text) for text in record["completions"]] for record in records],
+            [extract(record["answer"]) for record in records],
+            [record["entity"] for record in records],
+        )
+        return accumulator
+
+    def shard_metrics(self, shard: int) -> Optional[MetricsAccumulator]:
+        """Metrics of a shard, from its saved state when finished, else from the rows checkpointed so far"""
+        if os.path.exists(self._metrics_path(shard)):
+            with open(self._metrics_path(shard)) as f:
+                return MetricsAccumulator.from_state_dict(json.load(f))
+        return self._accumulate(None, list(self._records(shard)))
+
+    def completed_rows(self, shard: int) -> int:
+        """Number of rows checkpointed for a shard. A torn last line is cut off so it can be redone"""
+        path = self._path(shard)
+        if not os.path.exists(path):
+            return 0
+
+        rows, good_bytes = 0, 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                rows += 1
+                good_bytes += len(line)
+        if good_bytes != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_bytes)
+        return rows
+
+    def run_shard(self, shard: int):
+        if os.path.exists(self._done_path(shard)):
+            print(f"Shard {shard} already complete")
+            return
+
+        rows = self.shard_rows(shard)
+        done = self.completed_rows(shard)
+        accumulator = None
+        if done:
+            print(f"Resuming shard {shard} after {done} of {len(rows)} rows")
+            accumulator = self.shard_metrics(shard)
+
+        with open(self._path(shard), "a", encoding="utf-8") as f:
+            for start in range(rows.start + done, rows.stop, self.chunk_size):
+                chunk = self.dataset[start : min(start + self.chunk_size, rows.stop)]
+                prompts = [prompt[0]["content"] for prompt in chunk["prompt"]]
+                texts = self.generate_fn(prompts)
+
+                entities = chunk.get("entity", [""] * len(prompts))
+                records = [
+                    {"row": start + offset, "entity": entity, "answer": answer, "completions": completions}
+                    for offset, (answer, entity, completions) in enumerate(zip(chunk["answer"], entities, texts))
+                ]
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+                accumulator = self._accumulate(accumulator, records)
+                print(f"Shard {shard}: {accumulator.summary()}")
+
+        if accumulator is not None:
+            with open(self._metrics_path(shard), "w") as f:
+                json.dump(accumulator.state_dict(), f)
+        with open(self._done_path(shard), "w"):
+            pass
+        print(f"Shard {shard} complete ({len(rows)} rows)")
+
+    def run(self, rank: int = 0, world_size: int = 1, shards: Optional[Sequence[int]] = None):
+        """Processes the given shards, or every shard with shard % world_size == rank"""
+        if shards is None:
+            shards = [shard for shard in range(self.num_shards) if shard % world_size == rank]
+        for shard in shards:
+            self.run_shard(shard)
+
+    def _check_finished(self, allow_partial: bool):
+        unfinished = [shard for shard in range(self.num_shards) if not os.path.exists(self._done_path(shard))]
+        if unfinished and not allow_partial:
+            raise RuntimeError(f"Shards {unfinished} have not finished; rerun them or pass allow_partial=True")
+        if unfinished:
+            print(f"Warning: using the partial results of unfinished shards {unfinished}")
+
+    def read(self, allow_partial: bool = False) -> List[dict]:
+        """All checkpointed rows across shards, in dataset order"""
+        self._check_finished(allow_partial)
+        records = [record for shard in range(self.num_shards) for record in self._records(shard)]
+        return sorted(records, key=lambda record: record["row"])
+
+    def merge(self, allow_partial: bool = False) -> MetricsAccumulator:
+        """The shard accumulators merged into one"""
+        self._check_finished(allow_partial)
+        merged = None
+        for shard in range(self.num_shards):
+            accumulator = self.shard_metrics(shard)
+            if accumulator is None:
+                continue
+            merged = accumulator if merged is None else merged.merge(accumulator)
+        return merged or MetricsAccumulator(entity_types=tuple(LABEL_TO_STR.values()))
+
+    def rescore(self, allow_partial: bool = False) -> MetricsAccumulator:
+        """Metrics recomputed from the checkpointed completions, ignoring the saved shard states"""
+        accumulator = self._accumulate(None, self.read(allow_partial))
+        return accumulator or MetricsAccumulator(entity_types=tuple(LABEL_TO_STR.values()))
+
+
+def write_metrics(accumulator: MetricsAccumulator, path: str):
+    """Writes the metrics of an accumulator as JSON, with its counts so runs can be merged later"""
+    metrics = accumulator.metrics()
+    metrics["counts"] = accumulator.state_dict()
+    with open(path, "w") as f:
+        json.dump(metrics, f, default=lambda value: value.tolist())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded, resumable evaluation")
+    parser.add_argument("--data", default="data/conll03/mrc-ner.test")
+    parser.add_argument("--out-dir", required=True)
+    parser.add_argument("--num-shards", type=int, default=16)
+    parser.add_argument("--rank", type=int, default=0)
+    parser.add_argument("--world-size", type=int, default=1)
+    parser.add_argument("--shards", type=lambda value: [int(v) for v in re.split(r"[ ,]+", value) if v])
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--model", default="Qwen/Qwen2.5-1.5B-Instruct")
+    parser.add_argument("--num-samples", type=int, default=16)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--joint", action="store_true", help="one prompt per sentence for all entity types")
+    parser.add_argument("--stub", action="store_true", help="use stub_generate instead of vLLM")
+    parser.add_argument("--merge", action="store_true", help="only merge finished shards into metrics")
+    args = parser.parse_args()
+
+    test_df = load_conll_dataset(args.data, include_examples=True, compact=True, joint=args.joint)
+
+    if args.merge:
+        generate_fn = None
+    elif args.stub:
+        generate_fn = partial(stub_generate, joint=args.joint)
+    else:
+        from eval import load_llm, make_generate_fn
+
+        generate_fn = make_generate_fn(load_llm(args.model), args.num_samples, args.temperature, args.joint)
+
+    runner = ShardedEvalRunner(test_df, generate_fn, args.out_dir, args.num_shards, args.chunk_size)
+    if generate_fn is not None:
+        runner.run(args.rank, args.world_size, args.shards)
+
+    if args.merge or args.world_size == 1:
+        accumulator = runner.merge()
+        print(f"Evaluation Metrics: {accumulator.summary()}")
+        write_metrics(accumulator, os.path.join(args.out_dir, "metrics.json"))
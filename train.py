@@ -1,30 +1,52 @@
-import os
-import re
 import time
-import torch
-import pandas as pd
 
-from typing import Tuple
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, Tuple
 from dotenv import load_dotenv
-from trl import GRPOConfig, GRPOTrainer
-from datasets import load_dataset, Dataset
-from data_loading import load_conll_dataset
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from reward_logging import RewardDebugSink
+from reward_eval import CachedRewardEvaluator, RewardExecutor
+from profiling import TIMER, cprofile
 from rewards import (
         soft_format_reward_func,
         positive_entity_correctness_reward_func,
         negative_entity_correctness_reward_func,
-        correctness_reward_func
+        correctness_reward_func,
+        joint_format_reward_func,
+        joint_positive_entity_correctness_reward_func,
+        joint_negative_entity_correctness_reward_func,
+        joint_correctness_reward_func
 )
 
+# spawned reward workers re-import this module, so torch, trl and transformers are
+# imported in the functions that use them
+if TYPE_CHECKING:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
 load_dotenv()
 
+@dataclass
 class TrainingArgs:
+    """Training options; `python cli.py train --config ...` fills them from the config file's train section"""
     model_name: str = "Qwen/Qwen2.5-1.5B-Instruct"
     data_path: str = "data/conll03/mrc-ner.train"
     dataset: str = "conll"
+    # one prompt per sentence tagging all four entity types, instead of one prompt per type
+    joint: bool = False
+    # few-shot examples retrieved per context from the training split, instead of the static ones
+    dynamic_examples: bool = False
+    num_examples: int = 3
+    example_token_budget: int = 384
+    # "process" or "thread" split every reward call over reward_workers; only worth it for slow verifiers
+    reward_mode: str = "inline"
+    reward_workers: int = 4
+    demo: bool = False
+    # overrides for the GRPOConfig fields set in main
+    grpo: Dict[str, Any] = field(default_factory=dict)
+
+def load_model(model_name: str) -> Tuple["AutoModelForCausalLM", "AutoTokenizer"]:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
 
-def load_model(model_name: str) -> Tuple[AutoModelForCausalLM, AutoTokenizer]:
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
         torch_dtype=torch.bfloat16,
@@ -42,19 +64,33 @@ def get_run_output_name(model_name: str, demo: bool) -> Tuple[str, str]:
         run_name = f"demo_{model_name.split('/')[-1]}-{time.strftime('%Y-%m-%d %H:%M:%S')}-sysprompt_3"
     return output_dir, run_name
 
-if __name__ == "__main__":
-    args = TrainingArgs()
+def main(args: TrainingArgs):
+    from trl import GRPOConfig
+    from accelerate import PartialState
+    from data_loading import load_conll_dataset
+    from fewshot import FewShotSelector
+    from prompt_store import PromptTokenStore, PretokenizedTokenizer
+    from callbacks import StepTimingCallback, add_metrics_callback
+    from dynamic_sampling import DynamicSamplingGRPOTrainer
 
     model, tokenizer = load_model(args.model_name)
 
     if args.dataset == "conll":
-        data = load_conll_dataset(args.data_path)
+        example_selector = None
+        if args.dynamic_examples:
+            example_selector = FewShotSelector.from_conll(
+                args.data_path,
+                k=args.num_examples,
+                token_budget=args.example_token_budget,
+                count_tokens=lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"]),
+            )
+        data = load_conll_dataset(args.data_path, compact=True, joint=args.joint, example_selector=example_selector)
     else:
         raise ValueError(f"{args.dataset} dataset is not recognized")
     
-    output_dir, run_name = get_run_output_name(args.model_name, False)
+    output_dir, run_name = get_run_output_name(args.model_name, args.demo)
     
-    training_args = GRPOConfig(
+    grpo_kwargs = dict(
         output_dir=output_dir,
         run_name=run_name,
         learning_rate=5e-6,
@@ -76,18 +112,56 @@ if __name__ == "__main__":
         report_to="wandb",
         log_on_each_node=False,
     )
+    grpo_kwargs.update(args.grpo)
+    training_args = GRPOConfig(**grpo_kwargs)
+
+    # tokenise the prompts once; over-long prompts would be silently left-truncated by the trainer
+    prompt_store = PromptTokenStore(data, tokenizer, training_args.max_prompt_length)
+    data = data.select(prompt_store.keep_indices())
     
-    trainer = GRPOTrainer(
-        model=model,
-        processing_class = tokenizer,
-        reward_funcs=[
-            soft_format_reward_func,
-            positive_entity_correctness_reward_func,
-            negative_entity_correctness_reward_func,
-            correctness_reward_func
-        ],
-        args=training_args,
-        train_dataset=data,
-    )
-    
-    trainer.train()
\ No newline at end of file
+    # one file per rank, so ranks never write or rotate each other's records
+    reward_debug = RewardDebugSink(f"logs/{run_name}/rewards-rank{PartialState().process_index}", every_n_steps=10)
+    reward_executor = RewardExecutor(args.reward_mode, max_workers=args.reward_workers)
+    try:
+        if args.joint:
+            reward_funcs = [
+                joint_format_reward_func,
+                joint_positive_entity_correctness_reward_func,
+                joint_negative_entity_correctness_reward_func,
+                joint_correctness_reward_func
+            ]
+        else:
+            reward_funcs = [
+                soft_format_reward_func,
+                positive_entity_correctness_reward_func,
+                negative_entity_correctness_reward_func,
+                correctness_reward_func
+            ]
+        reward_evaluator = CachedRewardEvaluator(reward_funcs, executor=reward_executor)
+
+        # zero-advantage groups are replaced with fresh prompts, and always/never solved prompts are sampled less
+        trainer = DynamicSamplingGRPOTrainer(
+            model=model,
+            processing_class = PretokenizedTokenizer(tokenizer, prompt_store),
+            reward_funcs=reward_debug.wrap(TIMER.wrap(reward_evaluator.reward_funcs(), "reward/")),
+            args=training_args,
+            train_dataset=data,
+            solve_reward_func=reward_funcs[-1].__name__,
+        )
+        # per-stage and per-step wall time is logged next to the losses as timing/*
+        trainer.add_callback(StepTimingCallback(TIMER))
+        add_metrics_callback(trainer, reward_evaluator, trainer, TIMER)
+
+        # NER_PROFILE=<path> runs training under cProfile
+        with cprofile():
+            trainer.train()
+        TIMER.export(
+            f"logs/{run_name}/timing-rank{trainer.accelerator.process_index}.json",
+            model=args.model_name, joint=args.joint, dynamic_examples=args.dynamic_examples,
+        )
+    finally:
+        reward_executor.shutdown()
+        reward_debug.close()
+
+if __name__ == "__main__":
+    main(TrainingArgs())
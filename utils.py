@@ -90,4 +90,33 @@ Assistant:
 4. The rest of the words are verbs, adjectives, or other non-organization terms. 
 </think> <entity></entity>
 """
-}
\ No newline at end of file
+}
+
+JOINT_EXAMPLES = """
+Example 1:
+User: Japan began the defence of their Asian Cup title with a lucky 2-1 win against Syria in a Group C championship match on Friday .
+Assistant:
+<think> 1. **Person**: No names of people appear in the sentence. 
+2. **Location**: "Japan" and "Syria" are countries, which are politically and geographically defined locations. 
+3. **Organization**: The sentence talks about national teams through their countries, but no organization is named. 
+4. **Miscellaneous**: "Asian Cup" is a football tournament, an event, which falls under the miscellaneous category. "Group C" and "Friday" are not entities. 
+</think> <entities> <person></person> <location>Japan, Syria</location> <organization></organization> <miscellaneous>Asian Cup</miscellaneous> </entities>
+
+Example 2:
+User: China controlled most of the match and saw several chances missed until the 78th minute when Uzbek striker Igor Shkvyrin took advantage of a misdirected defensive header to lob the ball over the advancing Chinese keeper and into an empty net .
+Assistant:
+<think> 1. **Person**: "Igor Shkvyrin" is a full name (first name "Igor", last name "Shkvyrin") of a striker. 
+2. **Location**: "China" is a country. 
+3. **Organization**: No club, company or governing body is named. 
+4. **Miscellaneous**: "Uzbek" and "Chinese" are nationalities, which belong to the miscellaneous category. 
+</think> <entities> <person>Igor Shkvyrin</person> <location>China</location> <organization></organization> <miscellaneous>Uzbek, Chinese</miscellaneous> </entities>
+
+Example 3:
+User: Japan , co-hosts of the World Cup in 2002 and ranked 20th in the world by FIFA , are favourites to regain their title here .
+Assistant:
+<think> 1. **Person**: No names of people appear in the sentence. 
+2. **Location**: "Japan" is a country. 
+3. **Organization**: "FIFA" is the international governing body of football, an organization. 
+4. **Miscellaneous**: "World Cup" is a tournament, an event, which falls under the miscellaneous category. 
+</think> <entities> <person></person> <location>Japan</location> <organization>FIFA</organization> <miscellaneous>World Cup</miscellaneous> </entities>
+"""